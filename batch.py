@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Evaluates many independent Snek programs in parallel.
+
+Usage:
+    python3 batch.py [-j WORKERS] [--engine ENGINE] [--no-cache] PATH...
+
+Each PATH is a .snek file or a directory of them.  Every program runs in its
+own fresh global Environment in a pool of worker processes, and one JSON
+record per program is printed as soon as that program finishes.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import functools
+import multiprocessing
+
+import lab
+import vm
+
+engines = {
+    'tree': lab.evaluate,
+    'compiled': functools.partial(lab.evaluate, compiled=True),
+    'vm': vm.evaluate,
+}
+
+
+def find_programs(paths):
+    """
+    Expands a list of files and directories into a list of .snek files.
+    Directories are searched recursively, in sorted order.
+    """
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*.snek')
+            programs.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            programs.append(path)
+    return programs
+
+
+def evaluate_program(path, engine='compiled', cache=True):
+    """
+    Runs every top-level expression of the program at path in a fresh global
+    Environment, and returns a record of the form
+
+        {'program': path, 'ok': bool, 'results': [...]}
+
+    where results holds one {'ok': True, 'output': ...} or
+    {'ok': False, 'type': ...} dictionary per expression, as in test.py.
+    Outputs that are not numbers are given as 'SOMETHING'.  A program that
+    does not parse gets a single {'ok': False, 'type': 'SnekSyntaxError',
+    'when': 'parse'} result, as does one that fails to load for any other
+    reason (with the type of that error).
+    """
+    run = engines[engine]
+    try:
+        forms = lab.load_program(path, None if cache else False)
+    except (OSError, UnicodeDecodeError) as e:
+        return {'program': path, 'ok': False, 'results': [{'ok': False, 'type': type(e).__name__}]}
+    except Exception as e: #e.g. SnekSyntaxError; one bad program must not end the batch
+        results = [{'ok': False, 'type': type(e).__name__, 'when': 'parse'}]
+        return {'program': path, 'ok': False, 'results': results}
+    env = lab.Environment({})
+    results = []
+    for form in forms:
+        try:
+            out = run(form, env)
+        except Exception as e: #one failing expression must not end the batch
+            results.append({'ok': False, 'type': type(e).__name__})
+            continue
+        if not isinstance(out, (int, float)):
+            out = 'SOMETHING'
+        results.append({'ok': True, 'output': out})
+    return {'program': path, 'ok': all(r['ok'] for r in results), 'results': results}
+
+
+def run_batch(paths, workers=None, engine='compiled', cache=True):
+    """
+    Evaluates the programs at the given paths (files or directories) across a
+    pool of worker processes, yielding the record from evaluate_program for
+    each one as soon as it finishes, in completion order.
+
+    Arguments:
+        paths (list): .snek files and directories containing them
+        workers (int): number of processes; defaults to the number of CPUs
+        engine (str): 'compiled' (the default), 'tree' or 'vm'
+        cache (bool): whether to use the on-disk cache of parsed programs
+    """
+    programs = find_programs(paths)
+    if not programs:
+        return
+    job = functools.partial(evaluate_program, engine=engine, cache=cache)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(programs) // (workers * 8)))
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(job, programs, chunksize)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='.snek files or directories')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--engine', choices=sorted(engines), default='compiled')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or write the on-disk parse cache')
+    parsed = parser.parse_args()
+
+    total = failed = 0
+    for record in run_batch(parsed.paths, parsed.workers, parsed.engine, not parsed.no_cache):
+        total += 1
+        failed += not record['ok']
+        print(json.dumps(record), flush=True)
+    print('%d programs, %d with errors' % (total, failed), file=sys.stderr)
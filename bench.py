@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Snek interpreter.
+
+Usage:
+    python3 bench.py engines [-n REPEAT]
+    python3 bench.py memory [--sizes N,...]
+    python3 bench.py suite [--sizes N,...] [--workloads NAME,...] [--engine E]
+                           [-r REPEAT] [-o OUTPUT] [--compare BASELINE]
+
+engines: runs every program in the test corpus many times with the
+         tree-walking evaluate, with compiled closures and on the bytecode
+         VM, and reports the time each takes
+memory:  measures the memory kept alive by closures made inside calls with
+         many arguments, with closures capturing only their free variables
+         and with them keeping the whole frame of the call
+suite:   generates synthetic programs of each workload at each size, and
+         measures the time and peak memory of tokenize, parse and evaluate
+         separately.  Results are written as JSON; given the JSON of an
+         earlier run, it also reports which measurements got slower.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import functools
+import tracemalloc
+
+import lab
+import vm
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_corpus():
+    """
+    Loads the test programs as a list of (name, forms) pairs, where forms is
+    the list of parsed top-level expressions of the program.  Lines that do
+    not parse are left out.
+    """
+    corpus = []
+    for n in range(4, 13):
+        with open(os.path.join(TEST_DIRECTORY, 'test_inputs/%02d.json' % n)) as f:
+            corpus.append(('%02d.json' % n, json.load(f)))
+    pattern = os.path.join(TEST_DIRECTORY, 'test_inputs/*.snek')
+    for path in sorted(glob.glob(pattern)):
+        forms = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    forms.append(lab.parse(lab.tokenize(line)))
+                except lab.SnekSyntaxError:
+                    pass
+        corpus.append((os.path.basename(path), forms))
+    return corpus
+
+
+def run_forms(run, forms):
+    '''
+    Runs each form with run(form, env) in one fresh global environment,
+    ignoring Snek errors the same way the tests expect them
+    '''
+    env = lab.Environment({})
+    for form in forms:
+        try:
+            run(form, env)
+        except lab.SnekError:
+            pass
+
+
+def time_tree_walker(forms, repeat):
+    '''
+    Returns the seconds taken to run forms repeat times with evaluate
+    '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run_forms(lab.evaluate, forms)
+    return time.perf_counter() - start
+
+
+def time_compiled(forms, repeat, compile, run):
+    '''
+    Returns (compile seconds, run seconds) for compiling forms once with
+    compile and then running the results repeat times with run(code, env)
+    '''
+    start = time.perf_counter()
+    codes = [compile(form) for form in forms]
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run_forms(run, codes)
+    return compile_time, time.perf_counter() - start
+
+
+def bench_engines(repeat):
+    row = '%-10s %10.2f %10.2f %10.2f %8.1fx %8.1fx'
+    print('%-10s %10s %10s %10s %9s %9s' % ('program', 'tree (ms)', 'closures', 'vm', 'closures', 'vm'))
+    totals = [0, 0, 0]
+    for name, forms in load_corpus():
+        tree = time_tree_walker(forms, repeat)
+        _, closures = time_compiled(forms, repeat, lab.compile_tree, lambda code, env: code(env))
+        _, bytecode = time_compiled(forms, repeat, vm.compile, vm.execute)
+        for i, t in enumerate((tree, closures, bytecode)):
+            totals[i] += t
+        print(row % (name, tree*1000, closures*1000, bytecode*1000, tree/closures, tree/bytecode))
+    tree, closures, bytecode = totals
+    print(row % ('total', tree*1000, closures*1000, bytecode*1000, tree/closures, tree/bytecode))
+
+
+## SYNTHETIC WORKLOADS
+#each generator returns the source of a Snek program whose size grows with n
+
+def gen_arithmetic(n):
+    '''
+    One long n-ary arithmetic expression
+    '''
+    return '(+ %s)' % ' '.join('(* %d 2)' % i for i in range(n))
+
+def gen_nesting(n):
+    '''
+    Arithmetic nested n levels deep
+    '''
+    return '(+ 1 ' * n + '0' + ')' * n
+
+def gen_globals(n):
+    '''
+    n global definitions, each referring to the one before
+    '''
+    lines = ['(define g0 0)']
+    lines += ['(define g%d (+ g%d 1))' % (i, i - 1) for i in range(1, n)]
+    return '\n'.join(lines)
+
+def gen_closures(n):
+    '''
+    A chain of n nested closures, the innermost reading the outermost
+    variable (like test_inputs/23.snek)
+    '''
+    opens = ''.join('((lambda (v%d) ' % i for i in range(n))
+    closes = ''.join(') %d)' % i for i in reversed(range(n)))
+    return opens + 'v0' + closes
+
+def gen_calls(n):
+    '''
+    n functions, each calling the next one on its argument.  Snek has no
+    conditionals, so a chain of distinct functions stands in for recursion.
+    '''
+    lines = ['(define (f%d x) (+ 1 (f%d x)))' % (i, i + 1) for i in range(n)]
+    lines.append('(define (f%d x) x)' % n)
+    lines.append('(f0 0)')
+    return '\n'.join(lines)
+
+def gen_wide_lambdas(n):
+    '''
+    A lambda with n parameters, applied to n arguments
+    '''
+    params = ' '.join('p%d' % i for i in range(n))
+    args = ' '.join(str(i) for i in range(n))
+    return '((lambda (%s) (+ %s)) %s)' % (params, params, args)
+
+workloads = {
+    'arithmetic': gen_arithmetic,
+    'nesting': gen_nesting,
+    'globals': gen_globals,
+    'closures': gen_closures,
+    'calls': gen_calls,
+    'wide_lambdas': gen_wide_lambdas,
+}
+
+def gen_captured_frames(n):
+    '''
+    n closures, each made by a call with 50 other arguments that the closure
+    never uses
+    '''
+    params = ' '.join('a%d' % i for i in range(50))
+    args = ' '.join(str(i) for i in range(50))
+    lines = ['(define (make %s x) (lambda (y) (+ x y)))' % params]
+    lines += ['(define c%d (make %s %d))' % (i, args, i) for i in range(n)]
+    return '\n'.join(lines)
+
+
+def retained_memory(source, capture):
+    '''
+    Returns the bytes still allocated after running source with the tree
+    walker, while its global environment is alive.  capture sets
+    lab.capture_free_variables for the run.
+    '''
+    forms = list(lab.iter_parse(lab.tokenize(source)))
+    previous, lab.capture_free_variables = lab.capture_free_variables, capture
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        env = lab.Environment({})
+        for form in forms:
+            lab.evaluate(form, env)
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        lab.capture_free_variables = previous
+
+
+def bench_memory(sizes):
+    print('%8s %16s %16s %7s' % ('closures', 'whole frames (B)', 'captured (B)', 'ratio'))
+    for n in sizes:
+        source = gen_captured_frames(n)
+        whole = retained_memory(source, False)
+        captured = retained_memory(source, True)
+        print('%8d %16d %16d %6.1fx' % (n, whole, captured, whole / captured))
+
+
+evaluators = {
+    'tree': lab.evaluate,
+    'compiled': functools.partial(lab.evaluate, compiled=True),
+    'vm': vm.evaluate,
+}
+
+
+def run_program(evaluate, forms):
+    '''
+    Evaluates forms in order in one fresh global environment
+    '''
+    env = lab.Environment({})
+    for form in forms:
+        evaluate(form, env)
+
+
+def measure(func, repeat):
+    '''
+    Calls func() repeat times and returns (its last result, the best time in
+    seconds, the peak memory in bytes allocated during one more call)
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def bench_workload(name, n, engine, repeat):
+    """
+    Measures tokenize, parse and evaluate on the given workload at size n,
+    returning a dictionary of results.  If a phase fails, the type of the
+    exception is recorded under 'error' and later phases are skipped.
+    """
+    record = {'workload': name, 'size': n, 'engine': engine}
+    source = workloads[name](n)
+    evaluate = evaluators[engine]
+    phases = [
+        ('tokenize', lambda: lab.tokenize(source)),
+        ('parse', lambda: list(lab.iter_parse(tokens))),
+        ('evaluate', lambda: run_program(evaluate, forms)),
+    ]
+    tokens = forms = None
+    for phase, func in phases:
+        try:
+            result, seconds, peak = measure(func, repeat)
+        except (lab.SnekError, RecursionError) as e:
+            record['error'] = '%s in %s' % (type(e).__name__, phase)
+            break
+        record[phase + '_s'] = seconds
+        record[phase + '_peak_bytes'] = peak
+        if phase == 'tokenize':
+            tokens = result
+        elif phase == 'parse':
+            forms = result
+    return record
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints how each timing in results changed relative to the matching
+    record in baseline, marking those more than threshold times slower.
+    Returns the number of regressions.
+    '''
+    key = lambda r: (r['workload'], r['size'], r['engine'])
+    old = {key(r): r for r in baseline}
+    regressions = 0
+    for r in results:
+        before = old.get(key(r))
+        if before is None:
+            continue
+        for phase in ('tokenize', 'parse', 'evaluate'):
+            t, t0 = r.get(phase + '_s'), before.get(phase + '_s')
+            if not t or not t0:
+                continue
+            ratio = t / t0
+            flag = '  REGRESSION' if ratio > threshold else ''
+            regressions += bool(flag)
+            print('%-12s %7d %-8s %-8s %6.2fx%s' % (r['workload'], r['size'], r['engine'], phase, ratio, flag),
+                  file=sys.stderr)
+    return regressions
+
+
+def bench_suite(names, sizes, engine, repeat):
+    results = []
+    for name in names:
+        for n in sizes:
+            record = bench_workload(name, n, engine, repeat)
+            print('%-12s %7d %s' % (name, n, ' '.join(
+                '%s=%.4fs' % (phase, record[phase + '_s'])
+                for phase in ('tokenize', 'parse', 'evaluate') if phase + '_s' in record)
+                + ('  ' + record['error'] if 'error' in record else '')), file=sys.stderr)
+            results.append(record)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['engines', 'memory', 'suite'])
+    parser.add_argument('-n', '--repeat', type=int, default=200,
+                        help='engines: how many times to run each program')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='memory, suite: comma-separated program sizes')
+    parser.add_argument('--workloads', default=','.join(workloads),
+                        help='suite: comma-separated workload names')
+    parser.add_argument('--engine', choices=sorted(evaluators), default='tree',
+                        help='suite: which evaluator to measure')
+    parser.add_argument('-r', '--runs', type=int, default=3,
+                        help='suite: runs per measurement (the best is kept)')
+    parser.add_argument('-o', '--output', help='suite: write results to this JSON file')
+    parser.add_argument('--compare', help='suite: JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='suite: slowdown ratio reported as a regression')
+    parsed = parser.parse_args()
+
+    if parsed.benchmark == 'engines':
+        bench_engines(parsed.repeat)
+    elif parsed.benchmark == 'memory':
+        bench_memory([int(s) for s in parsed.sizes.split(',')])
+    else:
+        sizes = [int(s) for s in parsed.sizes.split(',')]
+        results = bench_suite(parsed.workloads.split(','), sizes, parsed.engine, parsed.runs)
+        if parsed.output:
+            with open(parsed.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
+            print()
+        if parsed.compare:
+            with open(parsed.compare) as f:
+                baseline = json.load(f)
+            if compare(results, baseline, parsed.threshold):
+                sys.exit(1)
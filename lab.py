@@ -1,4 +1,17 @@
+import io
+import os
+import re
+import sys
+import mmap
+import time
 import doctest
+import hashlib
+import pickle
+import marshal
+import operator
+import itertools
+import collections
+import multiprocessing
 class SnekError(Exception):
     """
     A type of exception to be raised if there is an error with a Snek
@@ -22,6 +35,12 @@ class SnekEvaluationError(SnekError):
     SnekNameError.
     """
     pass
+class SnekLimitError(SnekError):
+    """
+    Exception to be raised when a program runs for more steps or more time
+    than it was allowed (see vm.Task).
+    """
+    pass
 
 def number_or_symbol(x):
     """
@@ -45,234 +64,1614 @@ def number_or_symbol(x):
         except ValueError:
             return x
 
+_token_pattern = re.compile(r'[()]|[^\s();]+|;')
+
+def _source_lines(source):
+    '''
+    Given a string or a file object, lazily yields its lines one at a time
+    (line endings included).  Byte lines (e.g. from a binary file) are decoded.
+    '''
+    if isinstance(source, str):
+        start = 0
+        while start < len(source):
+            end = source.find('\n', start) + 1
+            if end == 0: #last line has no newline
+                end = len(source)
+            yield source[start:end]
+            start = end
+    else:
+        for line in source:
+            if isinstance(line, bytes):
+                line = line.decode()
+            yield line
+
+def generate_tokens(source):
+    """
+    Lazily splits a Snek program into tokens in a single pass, yielding a
+    (token, line, column) tuple for each one.  Lines and columns start at 1.
+
+    >>> list(generate_tokens('(spam ; eggs\\n  42)'))
+    [('(', 1, 1), ('spam', 1, 2), ('42', 2, 3), (')', 2, 5)]
+
+    Arguments:
+        source (str or file): the source code of a Snek program, either as a
+                              string or as an open file object
+    """
+    for lineno, line in enumerate(_source_lines(source), 1):
+        for match in _token_pattern.finditer(line):
+            token = match.group()
+            if token == ';': #rest of the line is a comment
+                break
+            yield token, lineno, match.start() + 1
+
 def tokenize(source):
     """
     Splits an input string into meaningful tokens (left parens, right parens,
     other whitespace-separated values).  Returns a list of strings.
 
     Arguments:
-        source (str): a string containing the source code of a Snek
-                      expression
-    """
-    new_source = ""
-    skip = False #tracks comments ;
-    for s in source:
-        if s == ';':
-            skip = True
-        if skip:
-            if s == '\n':
-                skip = False
-        if not skip: #adds spaces between relevant expressions to allow split()
-            if s in '()':
-                new_source+=" "+s+" "
+        source (str or file): a string containing the source code of a Snek
+                              expression, or a file object to read it from
+    """
+    return [token for token, _, _ in generate_tokens(source)]
+
+define_forms = ('define', 'define-memo')
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('parsed Snek expressions cannot be modified')
+
+class SExpr(list):
+    """
+    An immutable S-expression, as produced by parse.  It compares equal to a
+    list with the same elements, but any attempt to modify it raises a
+    TypeError, so one parsed tree can safely be cached, shared and evaluated
+    many times (even concurrently).  SExprs have no instance dict and are
+    allocated at their exact length, so they take less memory than the
+    lists parse used to build by appending.
+    """
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return (SExpr, (list(self),))
+
+def _rebuild(tree, make):
+    '''
+    Returns a copy of tree in which each list is replaced by make(a list of
+    its copied items), working bottom up with an explicit stack so that
+    trees of any depth can be copied
+    '''
+    if not isinstance(tree, list):
+        return tree
+    stack = [(tree, [])] #lists being copied, with the items copied so far
+    while True:
+        node, items = stack[-1]
+        if len(items) < len(node):
+            item = node[len(items)]
+            if isinstance(item, list):
+                stack.append((item, []))
             else:
-                new_source+=s
-    return new_source.split() #removes spaces and returns as list
+                items.append(item)
+            continue
+        stack.pop()
+        if not stack:
+            return make(items)
+        stack[-1][1].append(make(items))
+
+def freeze(tree):
+    """
+    Returns a copy of tree (e.g. a hand-built nested list) in which every
+    list is an SExpr, as in the output of parse.
+    """
+    return _rebuild(tree, SExpr)
+
+def thaw(tree):
+    """
+    Returns a copy of tree with every SExpr turned back into a plain list.
+    """
+    return _rebuild(tree, list)
 
-def find_paren(tokens):
+def _check_special_form(expr):
     '''
-    Given a list of tokens that starts with a left paren, returns the index of the matching right paren
+    Given a freshly parsed S-expression, raises a SnekSyntaxError if it is a
+    malformed define or lambda expression
     '''
-    lCount = 0
-    rCount = 0
-    for i, t in enumerate(tokens):
-        if t == '(':
-            lCount += 1
-        if t == ')':
-            rCount += 1
-        if rCount == lCount:
-            return i #return place of right paren
-    raise SnekSyntaxError
+    if not expr:
+        return
+    if expr[0] in define_forms:
+        if len(expr) != 3:
+            raise SnekSyntaxError
+        name = expr[1]
+        if isinstance(name, list): #function definition shorthand
+            if not name or not all(isinstance(n, str) for n in name):
+                raise SnekSyntaxError
+        elif not isinstance(name, str):
+            raise SnekSyntaxError
+    elif expr[0] == 'lambda':
+        if len(expr) != 3 or not isinstance(expr[1], list):
+            raise SnekSyntaxError
+        if not all(isinstance(p, str) for p in expr[1]):
+            raise SnekSyntaxError
+
+class Reader:
+    """
+    Incremental parser state: the S-expressions that have been opened but not
+    yet closed.  Tokens (or lines of source) can be fed in a piece at a time,
+    and each top-level expression is produced as soon as it is complete, so
+    an expression may span any number of pieces.
+
+    >>> r = Reader()
+    >>> list(r.feed('(define (sq x)\\n'))
+    []
+    >>> r.depth()
+    1
+    >>> list(r.feed('  (* x x)) sq 3'))
+    [['define', ['sq', 'x'], ['*', 'x', 'x']], 'sq', 3]
+    """
+    def __init__(self):
+        self.stack = [] #S-expressions that are still open
+
+    def depth(self):
+        '''
+        Returns how many S-expressions are currently open
+        '''
+        return len(self.stack)
+
+    def reset(self):
+        '''
+        Discards any partially read expression
+        '''
+        self.stack = []
+
+    def read(self, tokens):
+        '''
+        Lazily consumes an iterable of tokens, yielding each top-level
+        expression completed by them.  Raises a SnekSyntaxError on an
+        unmatched close paren or a malformed special form.
+        '''
+        stack = self.stack
+        for token in tokens:
+            if token == '(':
+                stack.append([])
+                continue
+            if token == ')':
+                if not stack: #unmatched parentheses
+                    raise SnekSyntaxError
+                expr = stack.pop()
+                _check_special_form(expr)
+                expr = SExpr(expr)
+            else:
+                expr = number_or_symbol(token)
+                if type(expr) is str: #share one copy of each symbol
+                    expr = sys.intern(expr)
+            if stack:
+                stack[-1].append(expr)
+            else:
+                yield expr
+
+    def feed(self, source):
+        '''
+        Like read, but tokenizes a string (e.g. one line of input) first
+        '''
+        return self.read(token for token, _, _ in generate_tokens(source))
+
+    def close(self):
+        '''
+        Ends the input, raising a SnekSyntaxError if an expression is still
+        open (a missing close paren)
+        '''
+        if self.stack:
+            self.reset()
+            raise SnekSyntaxError
+
+def iter_parse(tokens):
+    """
+    Lazily parses a stream of tokens, yielding each top-level expression as
+    soon as it is complete.  Uses an explicit stack of open S-expressions, so
+    each token is visited once and nesting depth is unlimited.
+
+    >>> list(iter_parse(['(', 'define', 'x', '2', ')', 'x']))
+    [['define', 'x', 2], 'x']
+
+    Arguments:
+        tokens (iterable): strings representing tokens
+    """
+    reader = Reader()
+    yield from reader.read(tokens)
+    reader.close()
 
 def parse(tokens):
     """
     Parses a list of tokens, constructing a representation where:
         * symbols are represented as Python strings
         * numbers are represented as Python ints or floats
-        * S-expressions are represented as Python lists
+        * S-expressions are represented as SExprs (immutable Python lists)
+
+    Raises a SnekSyntaxError unless the tokens form exactly one expression.
 
     Arguments:
         tokens (list): a list of strings representing tokens
     """
-    def p_helper(tokens,out,brackets):
+    exprs = iter_parse(tokens)
+    for expr in exprs:
+        for _ in exprs: #more than one expression
+            raise SnekSyntaxError
+        return expr
+    raise SnekSyntaxError #no expression at all
+
+class ParseCache:
+    """
+    An LRU cache in front of parse(tokenize(source)), keyed by source text.
+    It holds at most max_entries programs and at most max_bytes characters of
+    source in total; the least recently used entries are evicted first.
+    Parsed trees are shared between callers, who must not modify them.
+    """
+    def __init__(self, max_entries = 1024, max_bytes = 2**24):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() #source -> tree, oldest first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, source):
         '''
-        Given out and tokens, returns a parsed version of tokens and adds it to out
-        Brackets determines whether to wrap returned result in parentheses
+        Returns the parsed tree for source, parsing it only on a cache miss
         '''
-        #print('parse',tokens,out,brackets)
-        if tokens == []: #base case
-            return out
-        if tokens[0] == '(': #if starts with paren, recursive call on expression
-            res = p_helper(tokens[1:find_paren(tokens)],[],True)
-            if brackets:
-                out.append(res)
-            else:
-                out += res
-            return p_helper(tokens[find_paren(tokens)+1:],out,brackets)
-        if tokens[0] == ')': #unmatched parentheses
-            raise SnekSyntaxError
-        if len(tokens) < 2: #base case
-            if brackets:
-                return out+[number_or_symbol(tokens[0])]
-            if out != []:
-                raise SnekSyntaxError
-            return number_or_symbol(tokens[0])
-        if tokens[0] == 'define':
-            if len(tokens) < 3:
-                raise SnekSyntaxError
-            if tokens[2] == '(': #if defining to expression
-                if find_paren(tokens[2:]) != len(tokens[2:])-1:
-                    #print('t',tokens[2:],find_paren(tokens[2:]))
-                    raise SnekSyntaxError
-            if not isinstance(number_or_symbol(tokens[1]),str):
-                raise SnekSyntaxError
-        if tokens[0] == 'lambda':
-            if len(tokens) < 3:
-                raise SnekSyntaxError
-            if tokens[1] != '(':  #check if list of params
-                raise SnekSyntaxError
-            left = find_paren(tokens[1:]) #end of params paren
-            #print('paren from 1 to', 1+left)
-            for i in range(2,1+left):
-                if not isinstance(number_or_symbol(tokens[i]),str):
-                     raise SnekSyntaxError
-            right = find_paren(tokens[left+2:])
-            #print('paren from ',2+left,'to',right+left+2)
-            if right + left + 3 != len(tokens):
-                raise SnekSyntaxError
-        return p_helper(tokens[1:],out + [number_or_symbol(tokens[0])],brackets)
+        entries = self.entries
+        if source in entries:
+            self.hits += 1
+            entries.move_to_end(source)
+            return entries[source]
+        self.misses += 1
+        tree = parse(tokenize(source))
+        if len(source) <= self.max_bytes:
+            entries[source] = tree
+            self.nbytes += len(source)
+            while len(entries) > self.max_entries or self.nbytes > self.max_bytes:
+                old, _ = entries.popitem(last=False)
+                self.nbytes -= len(old)
+        return tree
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
 
-    return p_helper(tokens,[],False)
+parse_cache = ParseCache()
+
+_cache_magic = b'SNEK\x01' #bump if the format of cached programs changes
+
+def load_program(path, cache_dir = None):
+    """
+    Reads a .snek file and returns the list of its parsed top-level
+    expressions.  The result is also stored in a cache directory (by default
+    __snekcache__ next to the file), keyed by a hash of the file's contents,
+    so later loads of an unchanged file skip tokenizing and parsing.
+
+    Arguments:
+        path (str): the .snek file to load
+        cache_dir (str): where to keep cached programs; False disables the
+                         on-disk cache
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), '__snekcache__')
+    if cache_dir is False:
+        return list(iter_parse(tokenize(data.decode())))
+    cached = os.path.join(cache_dir, hashlib.sha256(data).hexdigest() + '.snekc')
+    try:
+        with open(cached, 'rb') as f:
+            blob = f.read()
+        if blob.startswith(_cache_magic):
+            return [freeze(form) for form in marshal.loads(blob[len(_cache_magic):])]
+    except (OSError, ValueError, EOFError, TypeError, RecursionError):
+        pass #missing or unreadable: parse the file again
+    forms = list(iter_parse(tokenize(data.decode())))
+    tmp = '%s.%d.tmp' % (cached, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(_cache_magic + marshal.dumps([thaw(form) for form in forms]))
+        os.replace(tmp, cached) #atomic, so readers never see a partial file
+    except (OSError, ValueError, RecursionError):
+        pass #caching is best-effort; marshal refuses very deep trees
+    finally:
+        try:
+            os.remove(tmp) #left behind only if the write failed
+        except OSError:
+            pass
+    return forms
+
+_mapped_token_pattern = re.compile(rb'[()]|[^\s();]+|;[^\n]*')
+
+def _mapped_tokens(buf):
+    '''
+    Lazily yields the tokens of the Snek source in a bytes-like buffer (such
+    as an mmap), skipping comments
+    '''
+    for match in _mapped_token_pattern.finditer(buf):
+        token = match.group()
+        if token[0] != 59: #';' starts a comment
+            yield token.decode()
+
+def run_file(path, env = None, compiled = False):
+    """
+    Evaluates the .snek file at path one top-level expression at a time, in
+    a single global Environment, and returns the value of the last one and
+    that Environment, like result_and_env.  The file is memory-mapped and
+    tokenized straight from the mapping; each expression is parsed,
+    evaluated and dropped before the next one is read, so memory use is
+    bounded by the largest single expression rather than by the file.
+
+    Arguments:
+        path (str): the .snek file to run
+        env: the global Environment to run it in (a fresh one if not given)
+        compiled (bool): passed on to evaluate
+    """
+    if env is None:
+        env = Environment({})
+    result = None
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0: #empty files cannot be mapped
+            return (result, env)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            tokens = _mapped_tokens(buf)
+            try:
+                for form in iter_parse(tokens):
+                    result = evaluate(form, env, compiled)
+            finally:
+                tokens.close() #release the mapping before it is closed
+    return (result, env)
+
+#Builtins take a list of argument values.  Each has a fast path for the
+#common two-argument case and handles longer lists in one linear pass; bad
+#operands (e.g. a function, or dividing by zero) raise SnekEvaluationError.
+#Operands are checked to be numbers before Python sees them, as Python would
+#happily add or repeat the lists pmap returns.
+
+_number_types = frozenset((int, float, bool))
+
+def _numbers(args):
+    '''
+    Raises SnekEvaluationError unless every one of args is a number
+    '''
+    for arg in args:
+        if type(arg) not in _number_types:
+            raise SnekEvaluationError
+
+def _add(args):
+    if len(args) == 2:
+        a, b = args
+        if type(a) in _number_types and type(b) in _number_types:
+            return a + b
+    _numbers(args)
+    return sum(args)
+
+def _subtract(args):
+    if len(args) == 2:
+        a, b = args
+        if type(a) in _number_types and type(b) in _number_types:
+            return a - b
+    _numbers(args)
+    if len(args) == 1:
+        return -args[0]
+    if not args:
+        raise SnekEvaluationError
+    return args[0] - sum(itertools.islice(args, 1, None))
+
+def _product(args, start):
+    '''
+    Multiplies args[start:] together from right to left
+    '''
+    result = args[-1]
+    for i in range(len(args) - 2, start - 1, -1):
+        result = args[i] * result
+    return result
+
+def _multiply(args):
+    if len(args) == 2:
+        a, b = args
+        if type(a) in _number_types and type(b) in _number_types:
+            return a * b
+    _numbers(args)
+    if not args:
+        raise SnekEvaluationError
+    return _product(args, 0)
+
+def _divide(args):
+    _numbers(args)
+    try:
+        if len(args) == 2:
+            return args[0] / args[1]
+        if len(args) == 1:
+            return args[0]
+        return args[0] / _product(args, 1)
+    except (IndexError, ZeroDivisionError):
+        raise SnekEvaluationError
+
+def _comparison(op):
+    '''
+    Returns a builtin that is true if op holds between each pair of
+    neighbouring arguments
+    '''
+    def compare(args):
+        if len(args) == 2:
+            a, b = args
+            if type(a) in _number_types and type(b) in _number_types:
+                return op(a, b)
+        _numbers(args)
+        return all(map(op, args, itertools.islice(args, 1, None)))
+    return compare
+
+def _numeric(func, nargs = None):
+    '''
+    Wraps a Python numeric function as a builtin: one taking exactly nargs
+    arguments, or, if nargs is None, one taking a single iterable of any
+    number of values (like min and max)
+    '''
+    def builtin(args):
+        _numbers(args)
+        try:
+            if nargs is None:
+                return func(args)
+            if len(args) != nargs:
+                raise SnekEvaluationError
+            return func(*args)
+        except (TypeError, ValueError):
+            raise SnekEvaluationError
+    return builtin
+
+pmap_threshold = 64 #fewer values than this are mapped serially
+pmap_workers = None #processes in the pmap pool; None means one per CPU
+_pmap_pool = None #(number of workers, multiprocessing.Pool)
+
+def _portable(value, memo):
+    '''
+    Returns a copy of a Function that can be sent to another process: a
+    plain Function whose environment holds just the bindings of its free
+    names (with any Functions among them made portable in turn), on top of
+    the builtins.  Other values are returned unchanged.
+    '''
+    if not isinstance(value, Function):
+        return value
+    if id(value) in memo:
+        return memo[id(value)]
+    env = Environment({})
+    func = Function(list(value.params), value.body, env)
+    func.name = value.name
+    memo[id(value)] = func #before the bindings, which may refer back to it
+    free, func.sealed = _closure_info(value.params, value.body)
+    for name in free:
+        try:
+            env.att[name] = _portable(value.env.lookup(name), memo)
+        except SnekNameError:
+            pass #an error in the worker too, if it is ever looked up
+    return func
+
+def _snapshot(value):
+    '''
+    Returns value, with any Functions in it made portable, pickled so that
+    builtins are sent by name
+    '''
+    buf = io.BytesIO()
+    _SnapshotPickler(buf, pickle.HIGHEST_PROTOCOL).dump(value)
+    return buf.getvalue()
+
+def _pmap_chunk(payload):
+    '''
+    Runs in a pmap worker: applies the pickled function to each of the
+    pickled values, and returns the results pickled in the same way
+    '''
+    func, values = _SnapshotUnpickler(io.BytesIO(payload)).load()
+    memo = {}
+    return _snapshot([_portable(func([value]), memo) for value in values])
+
+def _pmap(args):
+    """
+    (pmap f x1 x2 ...) applies the one-argument function f to each value
+    and returns the results in order (as a Python list, as Snek has no list
+    type of its own).  With at least pmap_threshold values the work is
+    spread over a pool of worker processes: f, and any functions among the
+    values, are sent along with the bindings of their free names, so later
+    changes to the environment are not seen.  Fewer values, functions that
+    cannot be sent, or a call from inside a worker are handled in this
+    process instead.
+    """
+    global _pmap_pool
+    if not args or not callable(args[0]):
+        raise SnekEvaluationError
+    func, values = args[0], args[1:]
+    if len(values) >= pmap_threshold and not multiprocessing.current_process().daemon:
+        workers = pmap_workers or os.cpu_count() or 1
+        size = -(-len(values) // (workers * 4))
+        try:
+            memo = {}
+            portable = _portable(func, memo)
+            payloads = [_snapshot((portable, [_portable(v, memo) for v in values[i:i + size]]))
+                        for i in range(0, len(values), size)]
+        except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+            payloads = None #e.g. a Python function that is not a builtin
+        if payloads is not None:
+            if _pmap_pool is None or _pmap_pool[0] != workers: #pmap_workers changed
+                if _pmap_pool is not None:
+                    _pmap_pool[1].terminate()
+                _pmap_pool = (workers, multiprocessing.Pool(workers))
+            return [out for chunk in _pmap_pool[1].map(_pmap_chunk, payloads)
+                    for out in _SnapshotUnpickler(io.BytesIO(chunk)).load()]
+    return [func([value]) for value in values]
 
 snek_builtins = {
-    "+": sum,
-    "-": lambda args: -args[0] if len(args) == 1 else (args[0] - sum(args[1:])),
-    "*": lambda args: args[0] if len(args) == 1 else (args[0]*snek_builtins["*"](args[1:])),
-    "/": lambda args: args[0] if len(args) == 1 else (args[0]/(snek_builtins["*"](args[1:]))),
+    "+": _add,
+    "-": _subtract,
+    "*": _multiply,
+    "/": _divide,
+    "=": _comparison(operator.eq),
+    "<": _comparison(operator.lt),
+    ">": _comparison(operator.gt),
+    "<=": _comparison(operator.le),
+    ">=": _comparison(operator.ge),
+    "abs": _numeric(abs, 1),
+    "min": _numeric(min),
+    "max": _numeric(max),
+    "pmap": _pmap,
 }
 
 class Environment:
-    def __init__(self,dict,parent = None):
-        self.att = {}
-        if dict != None:
-            for key in dict:
-                self.att[key] = snek_builtins[key]
-        if parent == None:
-            self.parent = Environment(snek_builtins, -1)
+    """
+    A frame of variable bindings, with a pointer to the parent frame that
+    names not bound here are looked up in.  Frames created without a parent
+    share a single frame holding the builtins.
+
+    Arguments:
+        bindings: a dict (or iterable of pairs) of names to bind in this frame
+        parent: the parent frame; None for the builtins, -1 for no parent
+        cache (bool): if True, remember which frame each looked-up name was
+                      found in, so later lookups skip the walk up the chain
+    """
+    version = 0 #bumped whenever a define adds a name to any frame
+    sealed = False #True for frames that no define can change any more
+
+    def __init__(self,bindings,parent = None,cache = False):
+        self.att = {} if bindings is None else dict(bindings)
+        if parent is None:
+            self.parent = builtin_env
+        elif parent == -1:
+            self.parent = None
         else:
             self.parent = parent
+        self.cache = {} if cache else None
+        self.cache_version = Environment.version
 
     def define(self,key,value):
+        if key not in self.att: #could shadow a name cached by a child frame
+            Environment.version += 1
         self.att[key] = value
 
     def get_keys(self):
         out = set(self.att.keys())
-        if self.parent == None or self.parent == -1:
+        if self.parent is None:
             return out
         res = self.parent.get_keys()
         for r in res:
             out.add(r)
         return out
 
+    def find(self,key):
+        '''
+        Returns the nearest frame (starting at this one) that binds key, or
+        None if there isn't one
+        '''
+        env = self
+        while env is not None:
+            if key in env.att:
+                return env
+            env = env.parent
+        return None
+
+    def lookup(self,key):
+        '''
+        Returns the value bound to key, raising a SnekNameError if it is not
+        bound in this frame or any of its ancestors
+        '''
+        cache = self.cache
+        if cache is None:
+            env = self
+            while env is not None:
+                att = env.att
+                if key in att:
+                    return att[key]
+                env = env.parent
+            raise SnekNameError(key)
+        if self.cache_version != Environment.version: #a define may shadow an entry
+            cache.clear()
+            self.cache_version = Environment.version
+        owner = cache.get(key)
+        if owner is None:
+            owner = self.find(key)
+            if owner is None:
+                raise SnekNameError(key)
+            cache[key] = owner
+        return owner.att[key]
+
     def get(self,key):
-        if key in self.att:
-            return self.att[key]
-        if self.parent != -1:
-            return self.parent.get(key)
-        raise KeyError
+        try:
+            return self.lookup(key)
+        except SnekNameError:
+            raise KeyError(key)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state['cache'] is not None: #owners may be stale by the time it is loaded
+            state['cache'] = {}
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.cache_version = Environment.version
+
+builtin_env = Environment(snek_builtins, -1)
 
 class Function:
-    def __init__(self,param,body,env = Environment({})):
+    sealed = False #True if the body defines nothing in the call's own frame
+
+    def __init__(self,param,body,env = None):
+        if env is None:
+            env = Environment({})
         self.params = param
         self.body = body
         self.env = env
+        self.name = None #set when the function is first bound by a define
+        self.memo = None #a MemoCache, if the function is memoized
+
+    def __call__(self,args):
+        '''
+        Calls the function on a list of already-evaluated arguments, the same
+        way builtins are called
+        '''
+        if len(args) != len(self.params):
+            raise SnekEvaluationError
+        if self.memo is None:
+            return self.run(args)
+        return self.memo.call(self,args)
+
+    def run(self,args):
+        '''
+        Evaluates the body with the params bound to args
+        '''
+        frame = Environment(zip(self.params,args),self.env)
+        if self.sealed:
+            frame.sealed = True
+        return evaluate(self.body,frame)
         '''
     def __str__(self):
         return '\nFUNC\nparams:'+str(self.params)+'\nbody:'+str(self.body)+'\nenv!!'+str(self.env.att)
         '''
 
-def evaluate(tree, env = Environment({})):
+default_memo_size = 1024
+
+class MemoCache:
+    """
+    An LRU cache of a memoized Function's results, keyed on the values (and
+    types, so that 2 and 2.0 stay apart) of its arguments.  At most maxsize
+    results are kept; hits and misses count lookups.  Calls with arguments
+    that cannot be hashed (such as the list pmap returns) are not remembered.
+    """
+    def __init__(self,maxsize = default_memo_size):
+        self.maxsize = maxsize
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self,args):
+        return tuple(args) + tuple(map(type,args))
+
+    def get(self,key):
+        '''
+        Returns (True, the remembered result) for a key from key(args), or
+        (False, None) if there is none, counting the hit or miss
+        '''
+        results = self.results
+        try:
+            found = key in results
+        except TypeError: #unhashable
+            return (False, None)
+        if found:
+            self.hits += 1
+            results.move_to_end(key)
+            return (True, results[key])
+        self.misses += 1
+        return (False, None)
+
+    def put(self,key,val):
+        results = self.results
+        try:
+            results[key] = val
+        except TypeError: #unhashable
+            return
+        if len(results) > self.maxsize:
+            results.popitem(last=False)
+
+    def call(self,func,args):
+        key = self.key(args)
+        found, val = self.get(key)
+        if found:
+            return val
+        val = func.run(args)
+        self.put(key,val)
+        return val
+
+def memoize(func,maxsize = default_memo_size):
+    """
+    Marks a Function as memoized, so calls with arguments it has seen before
+    return the remembered result instead of running the body again.  This is
+    what (define-memo (f ...) ...) does.  Returns func.
+    """
+    if not isinstance(func,Function):
+        raise SnekEvaluationError
+    func.memo = MemoCache(maxsize)
+    return func
+
+capture_free_variables = True #False makes closures keep their whole frame chain
+
+_closure_info_cache = {} #(id(body), params) -> (body, free names, sealed)
+
+def _nested_function(tree):
+    '''
+    Returns (params, body) if tree is a lambda or a function definition
+    shorthand, and None otherwise
+    '''
+    if len(tree) == 3 and isinstance(tree[1], list):
+        if tree[0] == 'lambda':
+            return tree[1], tree[2]
+        if tree[0] in define_forms and tree[1]:
+            return tree[1][1:], tree[2]
+    return None
+
+def _closure_info(params, body):
+    '''
+    Returns (the names body may look up besides params, whether body leaves
+    its frame unchanged) for a lambda.  The free names are over-approximated
+    by every symbol in body, including the free names of nested lambdas.
+    The results for body and every lambda nested in it are computed in one
+    pass and cached.
+    '''
+    info = _closure_info_cache.get((id(body), tuple(params)))
+    if info is not None and info[0] is body:
+        return info[1], info[2]
+    functions = [(params, body)] #every function in body, outermost first
+    todo = [body]
+    while todo:
+        tree = todo.pop()
+        if isinstance(tree, list) and tree:
+            nested = _nested_function(tree)
+            if nested is not None:
+                functions.append(nested)
+            todo.extend(tree)
+    if len(_closure_info_cache) + len(functions) > 65536: #bounded for long sessions
+        _closure_info_cache.clear()
+    #(id(body), params) -> free names, for the functions done so far; a body
+    #that is a single symbol is shared by every function with that body
+    free_names = {}
+    for params, body in reversed(functions): #nested functions come first
+        symbols = set()
+        sealed = True
+        todo = [body]
+        while todo:
+            tree = todo.pop()
+            if isinstance(tree, str):
+                symbols.add(tree)
+            elif isinstance(tree, list) and tree:
+                if tree[0] in define_forms:
+                    sealed = False
+                nested = _nested_function(tree)
+                if nested is None:
+                    todo.extend(tree)
+                    continue
+                symbols |= free_names[id(nested[1]), tuple(nested[0])]
+                if tree[0] in define_forms:
+                    symbols.add(tree[1][0])
+        free = frozenset(symbols.difference(params))
+        free_names[id(body), tuple(params)] = free
+        _closure_info_cache[id(body), tuple(params)] = (body, free, sealed)
+    return free, sealed
+
+def _closure(params, body, env):
+    """
+    Makes the Function for a lambda evaluated in env.  Rather than keeping
+    all of env, the Function keeps a new frame holding only the bindings of
+    its free variables, copied from the frames of env that can no longer
+    change (the frames of calls whose body defines nothing).  The first
+    frame that can still change (usually the global one) becomes that
+    frame's parent, so later defines there are seen as before.  Everything
+    else that env refers to can then be freed while the Function lives on.
+    """
+    free, sealed = _closure_info(params, body)
+    if capture_free_variables and env.sealed:
+        bindings = {}
+        frame = env
+        while frame.sealed:
+            att = frame.att
+            for name in (free if len(free) < len(att) else att):
+                if name in att and name in free and name not in bindings: #inner frames shadow outer
+                    bindings[name] = att[name]
+            frame = frame.parent
+        if bindings:
+            env = Environment(bindings, frame)
+            env.sealed = True
+        else:
+            env = frame
+    func = Function(params, body, env)
+    if sealed:
+        func.sealed = True
+    return func
+
+def evaluate(tree, env = None, compiled = False):
     """
     Evaluate the given syntax tree according to the rules of the Snek
-    language.
+    language.  Calls in tail position reuse the current Python frame, so
+    chains of tail calls run in constant stack space.
 
     Arguments:
         tree (type varies): a fully parsed expression, as the output from the
                             parse function
-        env: a optional pointer to an environment
-    """
-    if isinstance(tree,list): #if tree is a list
-        if tree[0] == 'define': #special define case
-            if isinstance(tree[1],list):
-                tree[2] = ['lambda',tree[1][1:],tree[2]]
-                val = evaluate(tree[2], env)
-                env.define(tree[1][0],val)
+        env: a optional pointer to an environment (a fresh global
+             environment if not given)
+        compiled (bool): if True, compile the tree to closures (see
+                         compile_tree) and run those instead of walking it
+    """
+    if env is None:
+        env = Environment({})
+    if compiled:
+        return compile_tree(tree)(env)
+    entered = 0 #functions this call has entered in the profiler prof
+    try:
+        while True: #calls in tail position loop back here instead of recursing
+            if isinstance(tree,list): #if tree is a list
+                if not tree: #nothing to call
+                    raise SnekEvaluationError
+                if tree[0] in define_forms: #special define case
+                    if isinstance(tree[1],list): #function definition shorthand
+                        val = _closure(tree[1][1:],tree[2],env)
+                        name = tree[1][0]
+                    else:
+                        val = evaluate(tree[2], env)
+                        name = tree[1]
+                    if tree[0] == 'define-memo':
+                        memoize(val)
+                    if type(val) is Function and val.name is None:
+                        val.name = name
+                    env.define(name,val)
+                    if _tracer is not None:
+                        _tracer.emit('define',name,val)
+                    return val
+                if tree[0] == 'lambda': #special lambda case
+                    return _closure(tree[1],tree[2],env)
+                func = evaluate(tree[0],env)
+                args = [evaluate(el,env) for el in tree[1:]]
+                if _tracer is not None and callable(func):
+                    return _tracer.call(func,args)
+                if type(func) is Function and func.memo is None:
+                    if len(args) != len(func.params): #wrong number of args
+                        raise SnekEvaluationError
+                    if _profiler is not None:
+                        prof = _profiler
+                        prof.enter(func)
+                        entered += 1
+                    #tail call: evaluate the body in this same loop
+                    tree, env = func.body, Environment(zip(func.params,args),func.env)
+                    if func.sealed:
+                        env.sealed = True
+                    continue
+                if callable(func):
+                    if _profiler is not None:
+                        return _profiler.call(func,args)
+                    return func(args)
+                raise SnekEvaluationError
+            if isinstance(tree,(int,float)): #if tree is a number
+                return tree
+            try: #if tree is a str (var name)
+                return env.lookup(tree)
+            except SnekNameError:
+                if _tracer is not None:
+                    _tracer.emit('unbound',tree,None)
+                raise
+    finally:
+        if entered: #tail calls all return at once
+            prof.exit(entered)
+
+def result_and_env(tree, env = None, compiled = False):
+    '''
+    Returns a tuple with 2 elements: the result of the evaluation and the environment (even if no env passed)
+    '''
+    if env is None:
+        env = Environment({})
+    return (evaluate(tree,env,compiled),env)
+
+foldable_ops = ('+', '-', '*', '/')
+
+def _bound_names(tree, out):
+    '''
+    Adds to the set out every name that tree binds, with define or as a
+    lambda parameter
+    '''
+    if not isinstance(tree, list) or not tree:
+        return
+    if tree[0] in define_forms:
+        out.update(tree[1] if isinstance(tree[1], list) else [tree[1]])
+    elif tree[0] == 'lambda' and isinstance(tree[1], list):
+        out.update(tree[1])
+    for t in tree:
+        _bound_names(t, out)
+
+def _contains_define(tree):
+    if not isinstance(tree, list) or not tree:
+        return False
+    return tree[0] in define_forms or any(_contains_define(t) for t in tree)
+
+def _substitute(tree, values):
+    '''
+    Returns a copy of tree with the symbols in the dict values replaced by
+    their values, except where an inner lambda rebinds them
+    '''
+    if isinstance(tree, str):
+        return values.get(tree, tree)
+    if not isinstance(tree, list) or not tree:
+        return tree
+    if tree[0] == 'lambda' and isinstance(tree[1], list):
+        inner = {k: v for k, v in values.items() if k not in tree[1]}
+        return SExpr(['lambda', tree[1], _substitute(tree[2], inner)])
+    return SExpr([_substitute(t, values) for t in tree])
+
+def _drop_dead_defines(body):
+    '''
+    Returns a copy of a function body in which every (define name value)
+    that binds a name in the body's own frame, where the name appears
+    nowhere else in the body (not even as a parameter of a nested lambda),
+    is replaced by value, which is what the define evaluates to.  Only code
+    in the body can see its frame, so nothing else can read such a name.
+    '''
+    counts = collections.Counter()
+    todo = [body]
+    while todo:
+        tree = todo.pop()
+        if isinstance(tree, str):
+            counts[tree] += 1
+        elif isinstance(tree, list):
+            todo.extend(tree)
+    def drop(tree):
+        if not isinstance(tree, list) or not tree or tree[0] == 'lambda':
+            return tree
+        if tree[0] in define_forms:
+            if isinstance(tree[1], list): #the new function's body is another frame
+                if tree[0] == 'define' and counts[tree[1][0]] == 1:
+                    return SExpr(['lambda', SExpr(tree[1][1:]), tree[2]])
+                return tree
+            if tree[0] == 'define' and counts[tree[1]] == 1:
+                return drop(tree[2])
+            return SExpr([tree[0], tree[1], drop(tree[2])])
+        return SExpr([drop(t) for t in tree])
+    return drop(body)
+
+def _optimize(tree, ops):
+    if not isinstance(tree, list) or not tree:
+        return tree
+    if tree[0] in define_forms or tree[0] == 'lambda':
+        body = _optimize(tree[2], ops)
+        if tree[0] == 'lambda' or isinstance(tree[1], list): #a function body
+            body = _drop_dead_defines(body)
+        return SExpr([tree[0], tree[1], body])
+    tree = SExpr([_optimize(t, ops) for t in tree])
+    head, args = tree[0], tree[1:]
+    if not all(isinstance(a, (int, float)) for a in args):
+        return tree
+    if isinstance(head, str) and head in ops: #builtin arithmetic on literals
+        try:
+            return snek_builtins[head](args)
+        except Exception: #e.g. division by zero: leave it for run time
+            return tree
+    if (isinstance(head, list) and len(head) == 3 and head[0] == 'lambda'
+            and len(head[1]) == len(args) and not _contains_define(head[2])
+            and not {'define', 'define-memo', 'lambda'} & set(head[1])):
+        #immediately-applied lambda: substitute the arguments into its body
+        return _optimize(_substitute(head[2], dict(zip(head[1], args))), ops)
+    return tree
+
+def optimize_program(forms, env = None, shadowed = ()):
+    """
+    Returns optimized copies (as SExprs) of a list of parsed expressions,
+    which evaluate to the same results:
+        * builtin arithmetic on literal operands is computed in advance
+        * lambdas applied directly to literal arguments are inlined
+        * defines in a function body whose name the body never refers to
+          are replaced by their value
+    An arithmetic operator is only folded if nothing in the program binds
+    its name (with define or as a parameter), the name is not in shadowed,
+    and, if env is given, it still refers to the builtin there.  The forms
+    themselves are not modified.
+
+    >>> optimize_program([['define', ['f', 'x'], ['*', 'x', ['+', 3, 4]]],
+    ...                   [['lambda', ['y'], ['-', 'y', 1]], 10]])
+    [['define', ['f', 'x'], ['*', 'x', 7]], 9]
+    """
+    names = set(shadowed)
+    for form in forms:
+        _bound_names(form, names)
+    ops = set()
+    for op in foldable_ops:
+        if op in names:
+            continue
+        if env is not None and env.find(op) is not builtin_env:
+            continue
+        ops.add(op)
+    return [_optimize(form, ops) for form in forms]
+
+def optimize(tree, env = None, shadowed = ()):
+    """
+    Optimizes a single parsed expression; see optimize_program.
+    """
+    return optimize_program([tree], env, shadowed)[0]
+
+class Profiler:
+    """
+    Collects, for each named Snek function and each builtin called by
+    evaluate, the number of calls, the cumulative time (including callees),
+    the self time (excluding callees) and the deepest recursion.  Profiling
+    is on while the Profiler is active:
+
+        with Profiler() as prof:
+            evaluate(tree, env)
+        print(prof.report())
+
+    Anonymous functions are counted together under 'lambda'.
+    """
+    def __init__(self):
+        self.stats = {} #name -> [calls, cumulative, self time, max depth]
+        self.stack = [] #[name, start time, time in callees] per active call
+        self.active = collections.Counter() #name -> activations on the stack
+        self.names = {id(f): name for name, f in snek_builtins.items()}
+        self.previous = None
+
+    def __enter__(self):
+        global _profiler
+        self.previous, _profiler = _profiler, self
+        return self
+
+    def __exit__(self, *exc):
+        global _profiler
+        _profiler = self.previous
+
+    def name(self, func):
+        return _name_of(func, self.names)
+
+    def enter(self, func):
+        name = self.name(func)
+        self.stack.append([name, time.perf_counter(), 0.0])
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        self.active[name] += 1
+        stats[3] = max(stats[3], self.active[name])
+
+    def exit(self, n = 1):
+        '''
+        Ends the n most recently entered calls
+        '''
+        now = time.perf_counter()
+        for _ in range(n):
+            name, start, inner = self.stack.pop()
+            elapsed = now - start
+            stats = self.stats[name]
+            stats[2] += elapsed - inner
+            self.active[name] -= 1
+            if not self.active[name]: #only the outermost call counts in full
+                stats[1] += elapsed
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def call(self, func, args):
+        '''
+        Calls a builtin (or other Python callable) on args, timing the call
+        '''
+        self.enter(func)
+        try:
+            return func(args)
+        finally:
+            self.exit()
+
+    def report(self):
+        '''
+        Returns the collected statistics as a table, most expensive first
+        '''
+        lines = ['%-20s %8s %12s %12s %6s' % ('function', 'calls', 'cum (ms)', 'self (ms)', 'depth')]
+        rows = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        for name, (calls, cum, own, depth) in rows:
+            lines.append('%-20s %8d %12.3f %12.3f %6d' % (name, calls, cum*1000, own*1000, depth))
+        return '\n'.join(lines)
+
+_profiler = None #the active Profiler, if any
+
+def _name_of(func, builtin_names):
+    '''
+    Returns the name of a Function ('lambda' if it is anonymous) or of a
+    builtin, given a dictionary from the ids of builtins to their names
+    '''
+    if isinstance(func, Function):
+        return func.name or 'lambda'
+    return builtin_names.get(id(func)) or getattr(func, '__name__', repr(func))
+
+TraceEvent = collections.namedtuple('TraceEvent', 'kind name value')
+
+class Tracer:
+    """
+    Records what evaluate does while the Tracer is active:
+
+        with Tracer() as tracer:
+            evaluate(tree, env)
+        print(tracer.dump())
+
+    Each event is a TraceEvent(kind, name, value), where kind is one of
+        'call'     a function or builtin called on the list of arguments value
+        'return'   it returned value
+        'raise'    it raised the exception value
+        'define'   name was bound to value
+        'unbound'  name was looked up but is not defined
+    The most recent size events are kept in a ring buffer, and each event is
+    also passed to every listener (a callable taking the event) as it
+    happens.  While no Tracer is active, evaluate only checks that none is.
+
+    Calls are traced one by one, so while tracing, the tree walker does not
+    run tail calls in constant stack space.
+    """
+    def __init__(self, listeners = (), size = 1000):
+        self.events = collections.deque(maxlen=size)
+        self.listeners = list(listeners)
+        self.names = {id(f): name for name, f in snek_builtins.items()}
+        self.previous = None
+
+    def __enter__(self):
+        global _tracer
+        self.previous, _tracer = _tracer, self
+        return self
+
+    def __exit__(self, *exc):
+        global _tracer
+        _tracer = self.previous
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, kind, name, value):
+        event = TraceEvent(kind, name, value)
+        self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+
+    def call(self, func, args):
+        '''
+        Calls a Function or builtin on args, tracing the call and its outcome
+        '''
+        name = _name_of(func, self.names)
+        self.emit('call', name, args)
+        try:
+            val = _profiler.call(func, args) if _profiler is not None else func(args)
+        except Exception as e:
+            self.emit('raise', name, e)
+            raise
+        self.emit('return', name, val)
+        return val
+
+    def dump(self):
+        '''
+        Returns the events in the ring buffer, oldest first, one per line
+        '''
+        lines = []
+        for kind, name, value in self.events:
+            if kind == 'call':
+                lines.append('call    %s %s' % (name, ' '.join(map(_show, value))))
+            elif kind == 'raise':
+                lines.append('raise   %s %s' % (name, type(value).__name__))
+            elif kind == 'unbound':
+                lines.append('unbound %s' % name)
             else:
-                val = evaluate(tree[2], env)
-                env.define(tree[1],val)
+                lines.append('%-7s %s %s' % (kind, name, _show(value)))
+        return '\n'.join(lines)
+
+    def clear(self):
+        self.events.clear()
+
+def _show(value):
+    '''
+    Returns a short description of a Snek value for trace dumps
+    '''
+    if isinstance(value, Function):
+        return '<function %s>' % (value.name or 'lambda')
+    if callable(value):
+        return '<builtin>'
+    return repr(value)
+
+_tracer = None #the active Tracer, if any
+
+class Scope:
+    """
+    The static layout of the frame for one lambda: the function's params come
+    first, followed by every name the body defines locally.  Each name gets a
+    fixed slot, so compiled code reads and writes variables by index.
+    """
+    __slots__ = ('names', 'index', 'nparams', 'blank', 'maybe_unbound')
+
+    def __init__(self, params, body):
+        self.nparams = len(params)
+        local = []
+        _find_defines(body, local)
+        self.names = list(params)
+        for name in local:
+            if name not in self.names:
+                self.names.append(name)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.blank = [_unbound] * (len(self.names) - self.nparams)
+        self.maybe_unbound = set(self.names[self.nparams:])
+
+def _find_defines(tree, out):
+    '''
+    Adds to out the names that tree defines in its own frame (defines nested
+    inside another lambda belong to that lambda's frame instead)
+    '''
+    if not isinstance(tree, list) or not tree:
+        return
+    if tree[0] == 'lambda':
+        return
+    if tree[0] in define_forms:
+        out.append(tree[1][0] if isinstance(tree[1], list) else tree[1])
+        if isinstance(tree[1], list):
+            return
+    for t in tree:
+        _find_defines(t, out)
+
+class _Unbound:
+    '''
+    Marks a local slot whose define has not run yet
+    '''
+    def __repr__(self):
+        return '<unbound>'
+
+    def __reduce__(self):
+        return '_unbound'
+_unbound = _Unbound()
+
+class Frame:
+    """
+    A call frame for compiled code.  Instead of a dict, a Frame stores its
+    values in a list laid out by its Scope.  globals is the dict-based
+    Environment at the bottom of the chain, where free names are looked up.
+    """
+    __slots__ = ('scope', 'values', 'parent', 'globals')
+
+    def __init__(self, scope, values, parent):
+        self.scope = scope
+        self.values = values
+        self.parent = parent
+        self.globals = parent.globals if type(parent) is Frame else parent
+
+    def lookup(self, key):
+        '''
+        Looks up a name dynamically, the same way Environment.lookup does
+        '''
+        i = self.scope.index.get(key)
+        if i is not None and self.values[i] is not _unbound:
+            return self.values[i]
+        return self.parent.lookup(key)
+
+class CompiledFunction(Function):
+    """
+    A Function created by compiled code: alongside its params and body it
+    keeps code, the body already compiled by compile_tree, and the Scope
+    describing the Frame that code expects.
+    """
+    def __init__(self, param, body, env, code, scope):
+        Function.__init__(self, param, body, env)
+        self.code = code
+        self.scope = scope
+
+    def run(self, args):
+        values = list(args)
+        if self.scope.blank:
+            values += self.scope.blank
+        return self.code(Frame(self.scope, values, self.env))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['code'] #a closure; compiled again after loading
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        def code(frame):
+            #compiled on the first call, as the enclosing Frames may still be
+            #half-loaded while this is being unpickled
+            scopes = (self.scope,)
+            env = self.env
+            while type(env) is Frame:
+                scopes += (env.scope,)
+                env = env.parent
+            self.code = compile_tree(self.body, scopes)
+            return self.code(frame)
+        self.code = code
+
+def _compile_global(name, in_frame):
+    '''
+    Returns a closure that looks name up in the global Environment.  Each
+    one is an inline cache: it remembers the frame of the chain that binds
+    the name, and reads the value straight from there for as long as the
+    global Environment and Environment.version stay the same (a define that
+    adds a name anywhere could shadow it).  Redefining the name in that
+    frame needs no invalidation, as the value is always read afresh.
+    '''
+    cached = (None, -1, None) #(global env, version, frame binding name)
+    def lookup(frame):
+        nonlocal cached
+        env = frame.globals if in_frame else frame
+        site = cached #one read, so threads sharing code see a consistent entry
+        if site[0] is env and site[1] == Environment.version:
+            return site[2].att[name]
+        version = Environment.version
+        owner = env.find(name)
+        if owner is None:
+            raise SnekNameError(name)
+        cached = (env, version, owner)
+        return owner.att[name]
+    return lookup
+
+def _compile_lookup(name, scopes, start=0):
+    '''
+    Resolves name against the enclosing scopes (innermost first), beginning
+    at depth start, and returns a closure that loads it from the right slot
+    '''
+    for depth in range(start, len(scopes)):
+        scope = scopes[depth]
+        if name not in scope.index:
+            continue
+        slot = scope.index[name]
+        if name in scope.maybe_unbound: #not defined yet: fall back outwards
+            outer = _compile_lookup(name, scopes, depth + 1)
+            def lookup(frame):
+                f = frame
+                for _ in range(depth):
+                    f = f.parent
+                val = f.values[slot]
+                if val is _unbound:
+                    return outer(frame)
+                return val
+        elif depth == 0:
+            def lookup(frame):
+                return frame.values[slot]
+        elif depth == 1:
+            def lookup(frame):
+                return frame.parent.values[slot]
+        else:
+            def lookup(frame):
+                for _ in range(depth):
+                    frame = frame.parent
+                return frame.values[slot]
+        return lookup
+    return _compile_global(name, bool(scopes))
+
+def _compile_define(name, value, scopes, memo=False):
+    if memo:
+        make = value
+        value = lambda frame: memoize(make(frame))
+    if scopes: #local define: store into this frame's slot
+        slot = scopes[0].index[name]
+        def define(frame):
+            val = value(frame)
+            frame.values[slot] = val
             return val
-        if tree[0] == 'lambda': #special lambda case
-            return Function(tree[1],tree[2],env)
-        if not isinstance((tree[0]),list):#check for user defined func
-            #new function
-            if tree[0] in env.get_keys(): #named function
-                if isinstance(env.get(tree[0]),Function) or callable(env.get(tree[0])):
-                    print('alirhgt',tree[0],isinstance(env.get(tree[0]),Function),callable(env.get(tree[0])))
-                    try:
-                        func = env.get(tree[0])
-                        print('named func',tree[0],func.env.att)
-                        funcEnv = Environment({},func.env)
-                        if len(tree) > 1:
-                            for i,p in enumerate(func.params):
-                                print('uh oh',tree,tree[1:])
-                                funcEnv.define(p,evaluate(tree[1:][i],env))
-                        res = evaluate(func.body,funcEnv)
-                        return res
-                    except AttributeError:
-                        pass
-        newTree = []
-        for i,el in enumerate(tree): #evaluate every el in list
-            res = evaluate(el,env)
-            if isinstance(res,Function): #if unnamed function
-                tree[i] = res
-                funcEnv = Environment({},res.env)
-                for j,p in enumerate(tree[i].params):
-                    funcEnv.define(p,evaluate(tree[1:][j],env))
-                res2 = evaluate(tree[i].body,funcEnv)
-                return res2
-            newTree.append(res)
-        if callable(newTree[0]) or isinstance(newTree[0],Function):
-            return newTree[0](newTree[1:])
+    else:
+        def define(env):
+            val = value(env)
+            env.define(name, val)
+            return val
+    return define
+
+def _compile_lambda(params, body, scopes):
+    scope = Scope(params, body)
+    code = compile_tree(body, (scope,) + scopes)
+    def make_function(frame):
+        return CompiledFunction(params, body, frame, code, scope)
+    return make_function
+
+def _compile_call(head, args):
+    def call(frame):
+        func = head(frame)
+        vals = [a(frame) for a in args]
+        if type(func) is CompiledFunction and func.memo is None: #inline the common case
+            if len(vals) != len(func.params):
+                raise SnekEvaluationError
+            if func.scope.blank:
+                vals += func.scope.blank
+            return func.code(Frame(func.scope, vals, func.env))
+        if callable(func):
+            return func(vals)
         raise SnekEvaluationError
-    if tree in snek_builtins: #if tree is an op
-        return snek_builtins[tree]
-    if isinstance(tree,(int,float)): #if tree is a number
-        return tree
-    if tree in env.get_keys():#if tree is a str (var name)
-        return env.get(tree)
-    print('t',tree,env.get_keys())
-    raise SnekNameError
+    return call
+
+def _compile_error(frame):
+    raise SnekEvaluationError
+
+def compile_tree(tree, scopes=()):
+    """
+    Compiles a parsed expression into a Python closure that takes an
+    environment and returns the expression's value.  All dispatch on the
+    shape of the tree happens once, here, instead of every time the
+    expression runs; the tree itself is never modified.
+
+    Variables bound by an enclosing lambda are resolved here to a (depth,
+    slot) address in the chain of Frames; every other name is looked up at
+    run time in the global Environment.
 
-def result_and_env(tree, env = Environment({})):
+    >>> env = Environment({})
+    >>> compile_tree(parse(tokenize('(define (double x) (* 2 x))')))(env) is not None
+    True
+    >>> compile_tree(parse(tokenize('(double 21)')))(env)
+    42
+
+    Arguments:
+        tree (type varies): a fully parsed expression, as the output from the
+                            parse function
+        scopes (tuple): Scopes of the enclosing lambdas, innermost first
+    """
+    if isinstance(tree, (int, float)):
+        return lambda frame: tree
+    if isinstance(tree, str):
+        return _compile_lookup(tree, scopes)
+    if not tree: #nothing to call
+        return _compile_error
+    if tree[0] in define_forms:
+        memo = tree[0] == 'define-memo'
+        if isinstance(tree[1], list): #function definition shorthand
+            value = _compile_lambda(tree[1][1:], tree[2], scopes)
+            return _compile_define(tree[1][0], value, scopes, memo)
+        return _compile_define(tree[1], compile_tree(tree[2], scopes), scopes, memo)
+    if tree[0] == 'lambda':
+        return _compile_lambda(tree[1], tree[2], scopes)
+    return _compile_call(compile_tree(tree[0], scopes), [compile_tree(t, scopes) for t in tree[1:]])
+
+_snapshot_magic = b'SNEKENV\x01' #bump if the snapshot format changes
+
+class _SnapshotPickler(pickle.Pickler):
     '''
-    Returns a tuple with 2 elements: the result of the evaluation and the environment (even if no env passed)
+    Pickles the builtins by name, so that a loaded snapshot shares them with
+    the running interpreter
+    '''
+    def __init__(self, file, protocol = None):
+        pickle.Pickler.__init__(self, file, protocol)
+        self.builtins = {id(f): name for name, f in snek_builtins.items()}
+
+    def persistent_id(self, obj):
+        if obj is builtin_env:
+            return 'builtins'
+        return self.builtins.get(id(obj))
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid == 'builtins':
+            return builtin_env
+        try:
+            return snek_builtins[pid]
+        except KeyError:
+            raise pickle.UnpicklingError('unknown builtin %r' % pid)
+
+def save_environment(env, path):
+    """
+    Writes a snapshot of env to the file at path: every binding in it and its
+    parent frames, including Functions with their params, bodies, closure
+    environments and memoized results.  Frames shared by several Functions
+    stay shared when the snapshot is loaded.  Functions made by compiled code
+    are compiled again on their first call after loading.
+
+    Arguments:
+        env (Environment): a global environment, e.g. after running a prelude
+        path (str): file to write
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_snapshot_magic)
+        _SnapshotPickler(f, pickle.HIGHEST_PROTOCOL).dump(env)
+    os.replace(tmp, path)
+
+def load_environment(path):
+    """
+    Loads an Environment written by save_environment.  Its builtins are those
+    of this interpreter.  Raises a ValueError if the file is not a snapshot.
+    Snapshots are pickles, so only load files from a trusted source.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_snapshot_magic)) != _snapshot_magic:
+            raise ValueError('%s is not a Snek environment snapshot' % path)
+        return _SnapshotUnpickler(f).load()
+
+def repl(stream = None):
     '''
-    return (evaluate(tree,env),env)
+    Reads, evaluates and prints Snek expressions until QUIT or the end of the
+    input.  Input is parsed incrementally: an expression may span several
+    lines, and each top-level expression is evaluated as soon as its
+    parentheses balance, so a whole program can be piped in on stdin.
+    PROFILE ON and PROFILE OFF start and stop the profiler, and PROFILE
+    prints its report.  TRACE ON and TRACE OFF start and stop tracing; while
+    it is on, the most recent trace events are printed after every error,
+    and TRACE prints them at any time.  These commands and QUIT must be on a
+    line of their own.
 
-def repl():
+    Arguments:
+        stream (file): where to read input from; defaults to sys.stdin.
+                       Prompts are only shown if it is a terminal.
+    '''
+    if stream is None:
+        stream = sys.stdin
+    interactive = stream is sys.stdin and stream.isatty()
     gEnv = Environment({})
-    quit = False
-    while not quit:
-        i = input('in:')
-        if i == 'QUIT':
-            quit = True
+    reader = Reader()
+    prof = None
+    tracer = None
+    while True:
+        if interactive:
+            try:
+                i = input('in:' if not reader.depth() else '...')
+            except EOFError:
+                break
         else:
-            t = tokenize(i)
-            #print('token',t)
-            p = parse(t)
-            #print('parse',p)
-            eval = evaluate(p,gEnv)
-            print('out>',eval)
+            i = stream.readline()
+            if not i:
+                break
+        command = i.strip() if not reader.depth() else None
+        if command == 'QUIT':
+            break
+        elif command == 'PROFILE ON':
+            if prof is None:
+                prof = Profiler().__enter__()
+        elif command == 'PROFILE OFF':
+            if prof is not None:
+                prof.__exit__()
+                print(prof.report())
+                prof = None
+        elif command == 'PROFILE':
+            print(prof.report() if prof is not None else 'profiler is off')
+        elif command == 'TRACE ON':
+            if tracer is None:
+                tracer = Tracer().__enter__()
+        elif command == 'TRACE OFF':
+            if tracer is not None:
+                tracer.__exit__()
+                tracer = None
+        elif command == 'TRACE':
+            print(tracer.dump() if tracer is not None else 'tracing is off')
+        else:
+            try:
+                for p in reader.feed(i):
+                    try:
+                        eval = evaluate(p,gEnv)
+                    except SnekError as e:
+                        if tracer is not None:
+                            print(tracer.dump())
+                            tracer.clear()
+                        print('error>', type(e).__name__)
+                    else:
+                        print('out>',eval)
+            except SnekSyntaxError:
+                reader.reset() #drop the rest of the malformed expression
+                print('error> SnekSyntaxError')
+    if prof is not None:
+        prof.__exit__()
+    if tracer is not None:
+        tracer.__exit__()
+    if reader.depth():
+        print('error> SnekSyntaxError')
 
 def doshit(str,env):
     print(evaluate(parse(tokenize(str))))
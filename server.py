@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Serves Snek over TCP or a Unix socket, and load-tests such a server.
+
+Usage:
+    python3 server.py serve [--host HOST] [--port PORT | --unix PATH]
+                            [-j WORKERS] [--engine ENGINE]
+    python3 server.py load [--host HOST] [--port PORT | --unix PATH]
+                           [-c SESSIONS] [-n REPEAT] [PROGRAM]
+
+serve: every connection is a session with its own global Environment, like
+       one run of lab.repl.  Clients send Snek source as lines of text;
+       expressions may span lines, and each top-level expression is
+       evaluated as soon as it is complete.  For each one the server sends
+       back a JSON line, {"ok": true, "output": ...} or
+       {"ok": false, "type": ...}, as in test.py (outputs that are not
+       numbers are given as 'SOMETHING').  Evaluation runs in a pool of
+       worker threads, so a session busy with a long computation does not
+       stop the server from reading, parsing and answering the others.
+load:  opens SESSIONS connections at once, sends PROGRAM (a .snek file, or
+       a small built-in program) REPEAT times over each, and reports the
+       throughput and the latency of the expressions.
+"""
+import sys
+import time
+import json
+import asyncio
+import argparse
+import concurrent.futures
+
+import lab
+import batch
+
+load_program_source = '(define (sq x) (* x x))\n(define (f a b)\n  (+ (sq a) (sq b)))\n(f 3 4)\n'
+line_limit = 2**24 #longest line of input a session may send, in bytes
+
+
+def render(value):
+    '''
+    Returns the JSON-friendly form of a Snek value
+    '''
+    return value if isinstance(value, (int, float)) else 'SOMETHING'
+
+
+class Session:
+    """
+    The state of one client connection: its global Environment and the
+    incremental parser for its input.
+    """
+    def __init__(self):
+        self.env = lab.Environment({})
+        self.reader = lab.Reader()
+
+
+class Server:
+    """
+    An asyncio Snek server.  Sessions are served concurrently; within one
+    session expressions are evaluated in the order they arrive.
+
+    Arguments:
+        workers (int): number of threads evaluating expressions
+        engine (str): 'compiled' (the default), 'tree' or 'vm'
+    """
+    def __init__(self, workers=4, engine='compiled'):
+        self.run = batch.engines[engine]
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.sessions = 0
+
+    async def evaluate(self, form, env):
+        '''
+        Evaluates form in env on the worker pool, returning the response
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            out = await loop.run_in_executor(self.executor, self.run, form, env)
+        except Exception as e: #a failing expression must not end the session
+            return {'ok': False, 'type': type(e).__name__}
+        return {'ok': True, 'output': render(out)}
+
+    async def handle(self, reader, writer):
+        '''
+        Serves one connection until the client closes it
+        '''
+        session = Session()
+        self.sessions += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    source = line.decode()
+                    for form in session.reader.feed(source):
+                        response = await self.evaluate(form, session.env)
+                        writer.write(json.dumps(response).encode() + b'\n')
+                except (lab.SnekSyntaxError, UnicodeDecodeError):
+                    session.reader.reset()
+                    writer.write(b'{"ok": false, "type": "SnekSyntaxError"}\n')
+                await writer.drain()
+        except (ConnectionError, ValueError): #ValueError: line over line_limit
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        '''
+        Starts listening on a Unix socket at path if it is given, and on
+        host and port otherwise.  Returns the asyncio server.
+        '''
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path, limit=line_limit)
+        return await asyncio.start_server(self.handle, host, port, limit=line_limit)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def connect(host='127.0.0.1', port=8765, path=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+async def run_session(source, repeat, host='127.0.0.1', port=8765, path=None):
+    '''
+    Sends source to a server repeat times over one connection, waiting for
+    the responses to each expression before sending the next.  Returns the
+    list of (latency in seconds, response) pairs.
+    '''
+    reader, writer = await connect(host, port, path)
+    results = []
+    try:
+        for _ in range(repeat):
+            parser = lab.Reader()
+            pending = []
+            for line in source.splitlines(True):
+                try:
+                    pending.extend(parser.feed(line))
+                except lab.SnekSyntaxError: #the server answers with an error
+                    parser.reset()
+                    pending.append(None)
+                writer.write(line.encode())
+                if not pending:
+                    continue
+                start = time.perf_counter()
+                await writer.drain()
+                for _ in pending:
+                    response = json.loads(await reader.readline())
+                    results.append((time.perf_counter() - start, response))
+                pending = []
+    finally:
+        writer.close()
+    return results
+
+
+async def load_test(source, sessions, repeat, host='127.0.0.1', port=8765, path=None):
+    """
+    Runs sessions concurrent run_session clients against a server, and
+    returns a dictionary with the number of expressions evaluated, how many
+    of them failed, the wall time, the throughput and latency percentiles.
+    """
+    start = time.perf_counter()
+    runs = await asyncio.gather(*[run_session(source, repeat, host, port, path)
+                                  for _ in range(sessions)])
+    elapsed = time.perf_counter() - start
+    results = [r for run in runs for r in run]
+    latencies = sorted(t for t, _ in results)
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+    return {
+        'expressions': len(results),
+        'errors': sum(not response['ok'] for _, response in results),
+        'seconds': elapsed,
+        'per_second': len(results) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(0.5) * 1000,
+        'p99_ms': percentile(0.99) * 1000,
+    }
+
+
+async def serve(parsed):
+    server = Server(parsed.workers, parsed.engine)
+    listener = await server.start(parsed.host, parsed.port, parsed.unix)
+    where = parsed.unix or '%s:%d' % (parsed.host, parsed.port)
+    print('serving Snek on %s' % where, file=sys.stderr)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'load'])
+    parser.add_argument('program', nargs='?', help='load: .snek file to send')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='path of a Unix socket to use instead of TCP')
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help='serve: number of evaluation threads')
+    parser.add_argument('--engine', choices=sorted(batch.engines), default='compiled')
+    parser.add_argument('-c', '--sessions', type=int, default=10,
+                        help='load: number of concurrent connections')
+    parser.add_argument('-n', '--repeat', type=int, default=100,
+                        help='load: times to send the program over each connection')
+    parsed = parser.parse_args()
+
+    if parsed.command == 'serve':
+        try:
+            asyncio.run(serve(parsed))
+        except KeyboardInterrupt:
+            pass
+    else:
+        source = load_program_source
+        if parsed.program:
+            with open(parsed.program) as f:
+                source = f.read()
+        stats = asyncio.run(load_test(source, parsed.sessions, parsed.repeat,
+                                      parsed.host, parsed.port, parsed.unix))
+        print(json.dumps(stats))
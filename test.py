@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 import os
 import lab
+import vm
 import sys
+import batch
+import server
+import transpile
+import bench
 import json
+import asyncio
+import functools
+import tracemalloc
 
 import pytest
 
@@ -36,13 +44,14 @@ def load_test_values(n):
     return inputs, outputs
 
 
-def run_continued_evaluations(ins):
+def run_continued_evaluations(ins, engine=lab.result_and_env):
     """
     Helper to evaluate a sequence of expressions in an environment.
+    engine is called like lab.result_and_env.
     """
     env = None
     outs = []
-    t = make_tester(lab.result_and_env)
+    t = make_tester(engine)
     for i in ins:
         if env is None:
             args = (i, )
@@ -74,18 +83,18 @@ def compare_outputs(x, y, msg):
         assert x['type'] == y['type'], msg + f'\n\nExpected {y.get("type", None)} to be raised, not {x.get("type", None)}'
         assert x.get('when', 'eval') == y.get('when', 'eval'), msg + f'\n\nExpected error to be raised at {y.get("when", "eval")} time, not at {x.get("when", "eval")} time.'
 
-def do_continued_evaluations(n):
+def do_continued_evaluations(n, engine=lab.result_and_env):
     """
     Test that the results from running continued evaluations in the same
     environment match the expected values.
     """
     inp, out = load_test_values(n)
     msg = message(n)
-    results = run_continued_evaluations(inp)
+    results = run_continued_evaluations(inp, engine)
     for result, expected in zip(results, out):
         compare_outputs(result, expected, msg)
 
-def do_raw_continued_evaluations(n):
+def do_raw_continued_evaluations(n, engine=lab.result_and_env):
     """
     Test that the results from running continued evaluations in the same
     environment match the expected values.
@@ -94,7 +103,7 @@ def do_raw_continued_evaluations(n):
         expected = json.load(f)
     env = None
     results = []
-    t = make_tester(lab.result_and_env)
+    t = make_tester(engine)
     with open('test_inputs/%02d.snek' % n) as f:
         for line in iter(f.readline, ''):
             try:
@@ -143,13 +152,80 @@ def message(n):
 def test_tokenize():
     run_test_number(1, lab.tokenize)
 
+def test_tokenize_file_and_positions():
+    with open('test_inputs/13.snek') as f:
+        source = f.read()
+    with open('test_inputs/13.snek') as f:
+        assert lab.tokenize(f) == lab.tokenize(source)
+    tokens = list(lab.generate_tokens('(spam ; comment\n   (eggs 4.5))'))
+    assert tokens == [('(', 1, 1), ('spam', 1, 2), ('(', 2, 4),
+                      ('eggs', 2, 5), ('4.5', 2, 10), (')', 2, 13), (')', 2, 14)]
+
 def test_parse():
     run_test_number(2, lab.parse)
 
+def test_parse_deep_and_many():
+    depth = 50000
+    tree = lab.parse(['('] * depth + ['x'] + [')'] * depth)
+    for _ in range(depth):
+        tree, = tree
+    assert tree == 'x'
+    tokens = lab.tokenize('(define x 2) x\n(+ x 3) 7')
+    assert list(lab.iter_parse(tokens)) == [['define', 'x', 2], 'x', ['+', 'x', 3], 7]
+    with pytest.raises(lab.SnekSyntaxError):
+        lab.parse(tokens)
+
+def test_repl_multiline_input(capsys):
+    class Lines:
+        # a stream that must not be read past the line that completes (sq 4)
+        def __init__(self, lines):
+            self.lines = iter(lines)
+        def readline(self):
+            line = next(self.lines)
+            if line is None:
+                assert 'out> 16' in capsys.readouterr().out
+                return 'QUIT\n'
+            return line
+    lab.repl(Lines(['(define (sq x)\n', '  (* x x)) (sq\n', '4)\n', None]))
+    lab.repl(Lines([')\n', '(+ 1 nope)\n', '(sq 2\n', ')\n', '(sq', '']))
+    out = [l for l in capsys.readouterr().out.splitlines() if l.startswith(('out>', 'error>'))]
+    assert out == ['error> SnekSyntaxError', 'error> SnekNameError', 'error> SnekNameError',
+                   'error> SnekSyntaxError']
+    reader = lab.Reader()
+    assert list(reader.feed('(+ 1')) == [] and reader.depth() == 1
+    assert list(reader.feed('2) (define')) == [['+', 1, 2]]
+    with pytest.raises(lab.SnekSyntaxError):
+        reader.close()
+    assert reader.depth() == 0
+
 def test_tokenize_and_parse():
     run_test_number(3, lambda i: lab.parse(lab.tokenize(i)))
 
 
+def test_parsed_trees_are_immutable():
+    tree = lab.parse(lab.tokenize('(define (f x) (+ x 1))'))
+    assert isinstance(tree, lab.SExpr) and isinstance(tree[1], lab.SExpr)
+    for mutate in (lambda: tree.append(1), lambda: tree.__setitem__(0, 'x'),
+                   lambda: tree[2].pop(), lambda: tree[1].sort()):
+        with pytest.raises(TypeError):
+            mutate()
+    assert lab.thaw(tree) == tree and type(lab.thaw(tree)) is list
+    assert type(lab.freeze(lab.thaw(tree))[2]) is lab.SExpr
+    assert hash(tree) == hash(lab.parse(lab.tokenize('(define (f x) (+ x 1))')))
+
+def test_shared_tree_concurrent_evaluation():
+    from concurrent.futures import ThreadPoolExecutor
+    program = list(lab.iter_parse(lab.tokenize(
+        '(define (sq x) (* x x)) (define (f a) ((lambda (b) (+ (sq a) b)) 3)) (f 4)')))
+    def run(engine):
+        env = lab.Environment({})
+        for form in program:
+            out = engine(form, env)
+        return out
+    engines = [lab.evaluate, vm.evaluate, bench.evaluators['compiled']] * 20
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(run, engines)) == {19}
+
 ## TESTS FOR CALCULATOR
 
 
@@ -242,6 +318,454 @@ def test_nested_defines():
 
 def test_syntax_errors():
     do_raw_continued_evaluations(29)
+
+
+def test_environment_lookup_cache():
+    glob = lab.Environment({})
+    for i in range(2000):
+        glob.define('v%d' % i, i)
+    middle = lab.Environment({}, glob)
+    inner = lab.Environment({}, middle, cache=True)
+    assert inner.lookup('v1999') == 1999
+    assert inner.lookup('+') is lab.snek_builtins['+']
+    assert inner.cache['v1999'] is glob
+    middle.define('v1999', 'shadowed')  # must invalidate the cached owner
+    assert inner.lookup('v1999') == 'shadowed'
+    with pytest.raises(lab.SnekNameError):
+        inner.lookup('nope')
+
+def test_closures_capture_free_variables():
+    env = lab.Environment({})
+    run = lambda s: lab.evaluate(lab.parse(lab.tokenize(s)), env)
+    run('(define (make big x) (lambda (y) (+ x y z)))')
+    add = run('(define add (make 1000 1))')
+    assert add.env.att == {'x': 1} and add.env.parent is env
+    run('(define z 100)') # later global defines are still seen
+    assert run('(add 2)') == 103
+    run('(define (outer x) (lambda (x) (lambda (w) (* x w))))')
+    assert run('(((outer 2) 3) 4)') == 12 # the innermost binding wins
+    run('(define (local x) ((lambda (g d) (g)) (lambda () y) (define y 5)))')
+    assert run('(local 1)') == 5 # frames with local defines are kept whole
+    run('(define k 99)')
+    run('(define (mk k) (lambda (q) (+ ((lambda (z) k) 2) ((lambda (k) k) 1))))')
+    assert run('((mk 10) 0)') == 11 # lambdas whose body is the same symbol
+    source = bench.gen_captured_frames(50)
+    assert bench.retained_memory(source, True) * 2 < bench.retained_memory(source, False)
+    assert lab.capture_free_variables
+
+def test_pmap_builtin(monkeypatch):
+    monkeypatch.setattr(lab, 'pmap_threshold', 8)
+    monkeypatch.setattr(lab, 'pmap_workers', 2)
+    env = lab.Environment({})
+    run = lambda s: lab.evaluate(lab.parse(lab.tokenize(s)), env)
+    for line in ['(define (sq x) (* x x))', '(define (make k) (lambda (x) (+ k (sq x))))',
+                 '(define f (make 0.5))']:
+        run(line)
+    values = ' '.join(str(i) for i in range(40))
+    assert run('(pmap f %s)' % values) == [i * i + 0.5 for i in range(40)]
+    assert run('(pmap (lambda (x) (* x 2)) 3 1 2)') == [6, 2, 4] # serial
+    assert lab.evaluate(lab.parse(lab.tokenize('(pmap f %s)' % values)), env, compiled=True)[39] == 1521.5
+    with pytest.raises(lab.SnekNameError):
+        run('(pmap (lambda (x) (nope x)) %s)' % values)
+    with pytest.raises(lab.SnekEvaluationError):
+        run('(pmap 3 %s)' % values)
+    squares = run('(define squares (pmap sq 1 2 3))')
+    run('(define-memo (same x) x)')
+    assert run('(same squares)') is squares and run('(same squares)') is squares # not remembered
+    for bad in ['(* squares 100000000)', '(+ squares squares)', '(- squares)', '(< squares squares)',
+                '(max squares squares)', '(/ squares 2)']:
+        with pytest.raises(lab.SnekEvaluationError):
+            run(bad)
+    run('(define (inc x) (+ x 1))')
+    assert run('(pmap (lambda (h) (h -3)) %s)' % ' '.join(['inc', 'abs'] * 5)) == [-2, 3] * 5
+    assert run('(pmap (lambda (h) (h -1 1)) %s)' % ' '.join(['<', '>'] * 5)) == [True, False] * 5
+    makers = run('(pmap (lambda (x) (lambda (y) (+ x y))) %s)' % values) # functions come back too
+    assert makers[39]([2]) == 41
+    monkeypatch.setattr(lab, 'pmap_workers', 3) # the pool follows the setting
+    assert run('(pmap f %s)' % values)[3] == 9.5 and lab._pmap_pool[0] == 3
+    lab._pmap_pool[1].terminate()
+    lab._pmap_pool = None
+
+def test_deep_tail_calls():
+    n = 5 * sys.getrecursionlimit()
+    source = '((lambda (x) ' * n + 'x' + ') (+ x 1))' * (n - 1) + ') 0)'
+    assert lab.evaluate(lab.parse(lab.tokenize(source))) == n - 1
+
+def test_run_file_streams_forms(tmp_path):
+    path = tmp_path / 'big.snek'
+    path.write_text('(define (sq x) ; squares (\n  (* x x))\n' + '(sq (+ 1 2 3 4 5 6 7 8 9 10))\n' * 4000 + '(sq 3)')
+    tracemalloc.start()
+    try:
+        result, env = lab.run_file(str(path))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert result == 9 and env.lookup('sq').name == 'sq'
+    assert peak < path.stat().st_size / 10
+    (tmp_path / 'empty.snek').write_text('')
+    assert lab.run_file(str(tmp_path / 'empty.snek'), compiled=True)[0] is None
+    (tmp_path / 'bad.snek').write_text('(sq 2) (sq')
+    with pytest.raises(lab.SnekSyntaxError):
+        lab.run_file(str(tmp_path / 'bad.snek'), env)
+
+def test_parse_cache_lru():
+    cache = lab.ParseCache(max_entries=2, max_bytes=30)
+    first = cache.parse('(+ 1 2)')
+    assert cache.parse('(+ 1 2)') is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    env = lab.Environment({})
+    for _ in range(2):  # shared trees survive being evaluated repeatedly
+        lab.evaluate(cache.parse('(define (f x) x)'), env)
+        assert lab.evaluate(cache.parse('(f 3)'), env) == 3
+    assert list(cache.entries) == ['(define (f x) x)', '(f 3)']
+    assert cache.nbytes == 21
+    cache.parse('(* 4 5 6 7 8 9 1 2 3)')  # too many bytes to keep both others
+    assert list(cache.entries) == ['(f 3)', '(* 4 5 6 7 8 9 1 2 3)']
+
+def test_program_disk_cache(tmp_path, monkeypatch):
+    program = tmp_path / 'prog.snek'
+    program.write_text('(define (sq x) (* x x))\n(sq 12) ; comment\n')
+    forms = lab.load_program(str(program))
+    assert forms == [['define', ['sq', 'x'], ['*', 'x', 'x']], ['sq', 12]]
+    assert len(list((tmp_path / '__snekcache__').iterdir())) == 1
+    deep = tmp_path / 'deep.snek'
+    deep.write_text('(-' * 3000 + ' 1' + ')' * 3000 + '\n5\n')
+    for _ in range(2):
+        tree, last = lab.load_program(str(deep))
+        depth = 0
+        while tree != 1:
+            tree, depth = tree[1], depth + 1
+        assert depth == 3000 and last == 5
+    assert not [p for p in (tmp_path / '__snekcache__').iterdir() if p.suffix == '.tmp']
+    def fail(tokens):
+        raise AssertionError('should have been loaded from the cache')
+    monkeypatch.setattr(lab, 'iter_parse', fail)
+    assert lab.load_program(str(program)) == forms
+
+## TESTS FOR ALTERNATE EXECUTION ENGINES
+
+def native_result_and_env(tree, env=None):
+    # translate every function to Python as soon as it is defined
+    out, env = lab.result_and_env(tree, env)
+    transpile.install(env)
+    return out, env
+
+engines = {
+    'compiled': functools.partial(lab.result_and_env, compiled=True),
+    'vm': vm.result_and_env,
+    'native': native_result_and_env,
+}
+
+@pytest.mark.parametrize('engine', engines)
+@pytest.mark.parametrize('n', range(6, 13))
+def test_engine_continued(engine, n):
+    do_continued_evaluations(n, engines[engine])
+
+@pytest.mark.parametrize('engine', engines)
+@pytest.mark.parametrize('n', range(13, 30))
+def test_engine_raw(engine, n):
+    do_raw_continued_evaluations(n, engines[engine])
+
+
+def test_compiled_frames():
+    env = lab.Environment({})
+    run = lambda s: lab.evaluate(lab.parse(lab.tokenize(s)), env, compiled=True)
+    run('(define y 1)')
+    run('(define (f x) (+ y (define y 10) y x))')
+    assert run('(f 5)') == 26  # y is global until the local define runs
+    assert run('y') == 1
+    run('(define (adder n) (lambda (i) (+ i n)))')
+    add3 = run('(define add3 (adder 3))')
+    assert isinstance(add3.env, lab.Frame) and add3.env.values == [3]
+    # functions compiled this way can still be called by the tree walker
+    assert lab.evaluate(lab.parse(lab.tokenize('(add3 4)')), env) == 7
+
+def test_vm_deep_calls_and_dis():
+    n = 5 * sys.getrecursionlimit()
+    # n nested non-tail calls: the VM keeps them on its own call stack
+    source = '(define (wrap x) x)' + '(wrap ' * n + '7' + ')' * n
+    env = lab.Environment({})
+    for tree in lab.iter_parse(lab.tokenize(source)):
+        result = vm.evaluate(tree, env)
+    assert result == 7
+    listing = vm.dis(vm.compile(lab.parse(lab.tokenize('(define (f x) (g x 2.5))'))))
+    assert 'MAKE_CLOSURE' in listing and 'TAIL_CALL      2' in listing and '(2.5)' in listing
+
+def test_vm_tasks_step_budget():
+    env = lab.Environment({})
+    vm.evaluate(lab.parse(lab.tokenize('(define (loop x) (loop (+ x 1)))')), env)
+    task = vm.Task(lab.parse(lab.tokenize('(loop 0)')), env, max_steps=5000)
+    assert task.run(steps=100) is False and task.steps == 100 and not task.done
+    with pytest.raises(lab.SnekLimitError):
+        task.run()
+    assert task.done and isinstance(task.error, lab.SnekLimitError) and task.steps == 5000
+    task = vm.Task(lab.parse(lab.tokenize('(loop 0)')), env, max_seconds=0.01)
+    with pytest.raises(lab.SnekLimitError):
+        task.run()
+    short = vm.Task(lab.parse(lab.tokenize('(+ 1 (* 2 3))')))
+    assert short.run(steps=1) is False and short.run(steps=1) is True and short.result == 7
+    programs = ['(loop 0)', '((lambda (x) (* x x)) 9)', 'nope', '(+ 2 3)']
+    tasks = [vm.Task(lab.parse(lab.tokenize(p)), env, max_steps=1000) for p in programs]
+    assert list(vm.schedule(tasks, steps=10)) == tasks[1:] + tasks[:1]
+    assert isinstance(tasks[0].error, lab.SnekLimitError) and tasks[0].steps == 1000
+    assert tasks[1].result == 81 and isinstance(tasks[2].error, lab.SnekNameError) and tasks[3].result == 5
+
+def test_vm_tasks_limit_all_functions():
+    env = lab.Environment({})
+    lab.evaluate(lab.parse(lab.tokenize('(define (spin x) (spin (+ x 1)))')), env)
+    vm.evaluate(lab.parse(lab.tokenize('(define-memo (loop x) (loop (+ x 1)))')), env)
+    for program in ['(spin 0)', '(loop 0)']:
+        task = vm.Task(lab.parse(lab.tokenize(program)), env, max_steps=100, max_seconds=5)
+        with pytest.raises(lab.SnekLimitError):
+            task.run()
+        assert task.steps == 100
+    lab.evaluate(lab.parse(lab.tokenize('(define-memo (sq x) (* x x))')), env)
+    task = vm.Task(lab.parse(lab.tokenize('(+ (sq 12) (sq 12) (sq 3))')), env, max_steps=100)
+    assert task.run() is True and task.result == 297
+    assert env.lookup('sq').memo.hits == 1 and env.lookup('sq').memo.misses == 2
+
+def test_compiled_call_site_caches():
+    parse = lambda s: lab.parse(lab.tokenize(s))
+    call = lab.compile_tree(parse('(f (- 5 1))'))
+    env = lab.Environment({})
+    lab.evaluate(parse('(define (f x) (* x 2))'), env)
+    assert call(env) == 8 and call(env) == 8
+    lab.evaluate(parse('(define (f x) (* x 3))'), env) # rebinding: same frame
+    assert call(env) == 12
+    lab.evaluate(parse('(define - +)'), env) # shadowing a builtin
+    assert call(env) == 18
+    other = lab.Environment({})
+    lab.evaluate(parse('(define (f x) x)'), other)
+    assert call(other) == 4 and call(env) == 18
+    with pytest.raises(lab.SnekNameError):
+        call(lab.Environment({}))
+
+def test_transpiled_functions():
+    env = lab.Environment({})
+    run = lambda s: lab.evaluate(lab.parse(lab.tokenize(s)), env)
+    run('(define (poly x y) (+ (* 3 x x) (- x) (/ x y 2) (< x y)))')
+    run('(define (f x) (+ (define z x) z))')
+    run('(define (apply g) (g 10))')
+    run('(define (g f) (+ f))')
+    expected = run('(poly 3 4)')
+    assert transpile.install(env) == ['poly', 'apply', 'g'] and 'f' in env.att
+    with pytest.raises(lab.SnekEvaluationError):
+        run('(g g)')
+    assert run('(g -0.0)') == 0.0 and run('(g 7)') == 7
+    for line in ['(define (add x y) (+ x y))', '(define (twice x) (* 2 x))', '(define (less x y) (< x y))',
+                 '(define (same x y) (= x y))', '(define (times f) (* f))', '(define (over f) (/ f))']:
+        run(line)
+    assert transpile.install(env, ['add', 'twice', 'less', 'same', 'times', 'over']) == [
+        'add', 'twice', 'less', 'same', 'times', 'over']
+    run('(define lst (pmap g 1 2 3))')
+    for bad in ['(add lst lst)', '(twice lst)', '(less lst lst)', '(same g g)', '(times g)', '(over g)']:
+        with pytest.raises(lab.SnekEvaluationError):
+            run(bad)
+    assert run('(add 1 2.5)') == 3.5 and run('(same 2 2.0)') and run('(over 4)') == 4
+    poly = env.lookup('poly')
+    assert type(poly) is transpile.NativeFunction and poly.name == 'poly'
+    out = run('(poly 3 4)')
+    assert out == expected and type(out) is type(expected)
+    with pytest.raises(lab.SnekEvaluationError):
+        run('(poly 1 0)')
+    with pytest.raises(lab.SnekEvaluationError):
+        run('(apply 3)')
+    assert run('(apply (lambda (n) (poly n 1)))') == 295.0
+    run('(define (- a) 100)') # shadows a builtin the translation relies on
+    assert run('(poly 3 4)') == 27 + 100 + 0.375 + 1
+
+def test_batch_evaluation(tmp_path, monkeypatch):
+    (tmp_path / 'a.snek').write_text('(define x 4)\n(* x x)\n')
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'b.snek').write_text('(+ 1 2)\nnope\n')
+    (tmp_path / 'bad.snek').write_text('(+ 1 2')
+    records = {os.path.relpath(r['program'], tmp_path): r
+               for r in batch.run_batch([str(tmp_path)], workers=2, cache=False)}
+    assert records == {
+        'a.snek': {'program': str(tmp_path / 'a.snek'), 'ok': True, 'results': [
+            {'ok': True, 'output': 4}, {'ok': True, 'output': 16}]},
+        os.path.join('sub', 'b.snek'): {'program': str(tmp_path / 'sub' / 'b.snek'), 'ok': False, 'results': [
+            {'ok': True, 'output': 3}, {'ok': False, 'type': 'SnekNameError'}]},
+        'bad.snek': {'program': str(tmp_path / 'bad.snek'), 'ok': False, 'results': [
+            {'ok': False, 'type': 'SnekSyntaxError', 'when': 'parse'}]},
+    }
+    def load(path, cache_dir=None):
+        raise RecursionError
+    monkeypatch.setattr(lab, 'load_program', load)
+    assert batch.evaluate_program(str(tmp_path / 'a.snek')) == {'program': str(tmp_path / 'a.snek'), 'ok': False,
+        'results': [{'ok': False, 'type': 'RecursionError', 'when': 'parse'}]}
+
+def test_server_sessions():
+    async def scenario():
+        srv = server.Server(workers=2)
+        listener = await srv.start(port=0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            (r1, w1), (r2, w2) = [await server.connect(port=port) for _ in range(2)]
+            w1.write(b'(define x\n 7) (* x\n')
+            w2.write(b'x\n)\n')
+            w1.write(b'2)\n')
+            replies = [json.loads(await r1.readline()) for _ in range(2)]
+            replies += [json.loads(await r2.readline()) for _ in range(2)]
+            for w in (w1, w2):
+                w.close()
+            stats = await server.load_test(server.load_program_source, 3, 4, port=port)
+        finally:
+            listener.close()
+            srv.close()
+        return replies, stats
+    replies, stats = asyncio.run(scenario())
+    assert replies == [{'ok': True, 'output': 7}, {'ok': True, 'output': 14},
+                       {'ok': False, 'type': 'SnekNameError'}, {'ok': False, 'type': 'SnekSyntaxError'}]
+    assert stats['expressions'] == 3 * 4 * 3 and stats['errors'] == 0
+
+def test_profiler():
+    env = lab.Environment({})
+    for line in ['(define (sq x) (* x x))',
+                 '(define (sumsq a b) (+ (sq a) (sq b)))',
+                 '(define (app f x) (f x))']:
+        lab.evaluate(lab.parse(lab.tokenize(line)), env)
+    with lab.Profiler() as prof:
+        program = '(sumsq 3 (app (lambda (y) (app sq y)) 2))'
+        assert lab.evaluate(lab.parse(lab.tokenize(program)), env) == 25
+    assert lab._profiler is None
+    calls = {name: stats[0] for name, stats in prof.stats.items()}
+    assert calls == {'sumsq': 1, 'sq': 3, 'app': 2, 'lambda': 1, '*': 3, '+': 1}
+    assert prof.stats['app'][3] == 2  # app is active twice at once
+    for name, (_, cum, own, _) in prof.stats.items():
+        assert 0 <= own <= cum
+    assert len(prof.report().splitlines()) == 1 + len(calls)
+
+def test_tracer(capsys):
+    env = lab.Environment({})
+    seen = []
+    with lab.Tracer([seen.append], size=4) as tracer:
+        for line in ['(define (sq x) (* x x))', '(sq 3)', '(define (f x) (g x))']:
+            lab.evaluate(lab.parse(lab.tokenize(line)), env)
+        with pytest.raises(lab.SnekNameError):
+            lab.evaluate(lab.parse(lab.tokenize('(f 2)')), env)
+    assert lab._tracer is None
+    assert [(e.kind, e.name) for e in seen] == [
+        ('define', 'sq'), ('call', 'sq'), ('call', '*'), ('return', '*'), ('return', 'sq'),
+        ('define', 'f'), ('call', 'f'), ('unbound', 'g'), ('raise', 'f')]
+    assert seen[1].value == [3] and seen[4].value == 9
+    assert tracer.dump().splitlines() == ['define  f <function f>', 'call    f 2', 'unbound g', 'raise   f SnekNameError']
+    lab.evaluate(lab.parse(lab.tokenize('(sq 4)')), env)
+    assert len(seen) == 9 and capsys.readouterr().out == ''
+
+def test_bench_workloads():
+    for name in bench.workloads:
+        record = bench.bench_workload(name, 5, 'compiled', 1)
+        assert 'error' not in record
+        assert all(record[phase + '_s'] >= 0 and record[phase + '_peak_bytes'] >= 0
+                   for phase in ('tokenize', 'parse', 'evaluate'))
+
+def outcomes(forms):
+    """
+    Evaluates forms in one environment, returning each value or error type
+    """
+    env = lab.Environment({})
+    results = []
+    for form in forms:
+        try:
+            out = lab.evaluate(form, env)
+            results.append(out if isinstance(out, (int, float)) else 'SOMETHING')
+        except lab.SnekError as e:
+            results.append(type(e).__name__)
+    return results
+
+@pytest.mark.parametrize('n', range(13, 30))
+def test_optimizer_preserves_results(n):
+    forms = bench.load_corpus()[n - 4][1]
+    optimized = lab.optimize_program(forms)
+    assert outcomes(optimized) == outcomes(forms)
+    assert forms == bench.load_corpus()[n - 4][1]  # not modified
+
+def test_optimizer_folding():
+    run = lambda s: lab.optimize_program(list(lab.iter_parse(lab.tokenize(s))))
+    assert run('(define (f x) (+ x (* 2 (+ 3 4))))') == [['define', ['f', 'x'], ['+', 'x', 14]]]
+    assert run('((lambda (a b) (lambda (c) (+ a b c))) 1 2)') == [['lambda', ['c'], ['+', 1, 2, 'c']]]
+    assert run('((lambda (a) ((lambda (a) (* a 2)) 5)) 1)') == [10]
+    # user definitions of an operator anywhere in the program stop folding
+    assert run('(define (g) (* 2 3)) (define (* a b) (+ a b))')[0] == ['define', ['g'], ['*', 2, 3]]
+    env = lab.Environment({})
+    env.define('-', lab.snek_builtins['+'])
+    assert lab.optimize(['-', 5, 1], env) == ['-', 5, 1]
+    assert lab.optimize(['/', 5, 0]) == ['/', 5, 0]
+    # defines in a function body that nothing in the body refers to
+    assert run('(define (f x) (+ x (define y (* 2 3)) (define z 1) z))') == [
+        ['define', ['f', 'x'], ['+', 'x', 6, ['define', 'z', 1], 'z']]]
+    assert run('(lambda (x) (g (define (h a) a) (lambda (h) h)))') == [
+        ['lambda', ['x'], ['g', ['define', ['h', 'a'], 'a'], ['lambda', ['h'], 'h']]]]
+    assert run('(lambda (x) (g (define (h a) a) (define-memo m x)))') == [
+        ['lambda', ['x'], ['g', ['lambda', ['a'], 'a'], ['define-memo', 'm', 'x']]]]
+    assert run('(define top 1)') == [['define', 'top', 1]]
+
+def test_nary_builtins():
+    b = lab.snek_builtins
+    many = [1] * 100000
+    assert b['*'](many) == 1 and b['/'](many) == 1.0
+    assert b['-'](many) == -99998 and b['+'](many) == 100000
+    for op, args, expected in [('-', [5], -5), ('/', [4], 4), ('*', [3], 3), ('/', [8, 2, 2], 2.0),
+                               ('-', [10, 1, 2.5], 6.5), ('*', [2, 3, 4], 24), ('+', [], 0)]:
+        out = b[op](args)
+        assert out == expected and type(out) is type(expected)
+    assert b['<']([1, 2, 3]) is True and b['<']([1, 3, 2]) is False
+    assert b['=']([2, 2.0, 2]) is True and b['>=']([3, 3, 1]) is True
+    assert b['abs']([-4]) == 4 and b['min']([3, 1, 2]) == 1 and b['max']([3, 1.5]) == 3
+    assert b['min']([5]) == 5 and b['max']([2.5]) == 2.5
+    for op, args in [('/', [1, 0]), ('*', []), ('-', []), ('min', []), ('abs', [1, 2]),
+                     ('+', [1, b['+']]), ('<', [1, b['+']])]:
+        with pytest.raises(lab.SnekEvaluationError):
+            b[op](args)
+    env = lab.Environment({})
+    for run in bench.evaluators.values():
+        assert run(lab.parse(lab.tokenize('(max (abs -7) (* 2 3))')), env) == 7
+
+@pytest.mark.parametrize('engine', ['tree', 'compiled', 'vm'])
+def test_memoized_functions(engine):
+    run = bench.evaluators[engine]
+    env = lab.Environment({})
+    for line in ['(define-memo (sq x) (* x x))', '(define (quad x) (sq (sq x)))',
+                 '(quad 3)', '(quad 3)', '(sq 9)', '(sq 9.0)']:
+        out = run(lab.parse(lab.tokenize(line)), env)
+    assert out == 81.0 and isinstance(out, float)
+    sq = env.lookup('sq')
+    assert (sq.memo.hits, sq.memo.misses) == (3, 3)
+    with pytest.raises(lab.SnekSyntaxError):
+        lab.parse(lab.tokenize('(define-memo (f x))'))
+    with pytest.raises(lab.SnekEvaluationError):
+        run(lab.parse(lab.tokenize('(define-memo seven 7)')), env)
+
+@pytest.mark.parametrize('engine', ['tree', 'compiled', 'vm'])
+def test_environment_snapshot(engine, tmp_path):
+    run = bench.evaluators[engine]
+    env = lab.Environment({})
+    for line in ['(define (make-adder n) (lambda (x) (+ x n)))', '(define add3 (make-adder 3))',
+                 '(define-memo (sq x) (* x x))', '(sq 5)',
+                 '(define (f x) ((lambda (y) (lambda (z) (+ y z))) (* x 2)))', '(define g (f 10))']:
+        run(lab.parse(lab.tokenize(line)), env)
+    path = str(tmp_path / 'prelude.snap')
+    lab.save_environment(env, path)
+    loaded = lab.load_environment(path)
+    assert loaded.parent is lab.builtin_env and loaded.lookup('+') is lab.snek_builtins['+']
+    assert loaded.lookup('make-adder').env is loaded and type(loaded.lookup('g')) is type(env.lookup('g'))
+    outs = [run(lab.parse(lab.tokenize(line)), loaded) for line in ['(add3 1)', '(sq 5)', '(g 1)', '(f 1)']]
+    assert outs[:3] == [4, 25, 21] and outs[3]([2]) == 4
+    assert loaded.lookup('sq').memo.hits == 1
+    (tmp_path / 'junk').write_bytes(b'not a snapshot')
+    with pytest.raises(ValueError):
+        lab.load_environment(str(tmp_path / 'junk'))
+
+def test_memoize_api_eviction():
+    env = lab.Environment({})
+    inc = lab.evaluate(lab.parse(lab.tokenize('(define (inc x) (+ x 1))')), env)
+    lab.memoize(inc, maxsize=2)
+    for x in (1, 2, 1, 3, 2):
+        assert inc([x]) == x + 1
+    assert (inc.memo.hits, inc.memo.misses) == (1, 4)
+    assert list(inc.memo.results) == [(3, int), (2, int)]
+
 #'''
 if __name__ == '__main__':
     import os
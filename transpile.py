@@ -0,0 +1,267 @@
+"""
+Translates Snek functions into Python functions.
+
+This is an optional backend for the hottest functions of a program: native
+turns a lab.Function into a NativeFunction, whose body has been translated
+to Python source and compiled with the built-in compile, so that a call runs
+as ordinary CPython bytecode.  install does this for the functions bound in
+an Environment:
+
+    env = lab.Environment({})
+    lab.evaluate(lab.parse(lab.tokenize('(define (sq x) (* x x))')), env)
+    install(env)
+    lab.evaluate(lab.parse(lab.tokenize('(sq 12)')), env)  # runs in Python
+
+Calls to the arithmetic and comparison builtins become Python operators,
+applied to operands checked to be numbers as the builtins would.  Such
+builtins are resolved when the function is translated, so every call first
+checks (cheaply, using Environment.version) that none of them has been
+shadowed since, and falls back to lab.evaluate if one has.  Other free names
+are looked up in the function's environment at each use, as usual.  A
+lambda inside the body is left to lab.evaluate, in a frame binding the
+params, so closures behave exactly as in the interpreter.  Functions whose
+body defines names in their own frame are not translated.
+"""
+import math
+
+import lab
+
+#builtins that become a Python operator in the binary case
+binary_ops = {'+': '+', '-': '-', '*': '*', '/': '/',
+              '=': '==', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+
+def _call(func, args):
+    if callable(func):
+        return func(args)
+    raise lab.SnekEvaluationError
+
+
+def _fail():
+    raise lab.SnekEvaluationError
+
+
+def _num(value):
+    if type(value) in lab._number_types:
+        return value
+    raise lab.SnekEvaluationError
+
+
+def _defines_locally(tree):
+    '''
+    Returns whether tree contains a define that binds a name in the frame it
+    is evaluated in (rather than in the frame of a nested lambda)
+    '''
+    if not isinstance(tree, list) or not tree:
+        return False
+    if tree[0] == 'lambda':
+        return False
+    return tree[0] in lab.define_forms or any(_defines_locally(t) for t in tree)
+
+
+class _Translator:
+    '''
+    Translates the body of one function, collecting the constants and
+    builtins the generated code refers to
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.locals = {name: 'a%d' % i for i, name in enumerate(func.params)}
+        self.namespace = {'_call': _call, '_fail': _fail, '_num': _num, '_lookup': func.env.lookup,
+                          '_evaluate': lab.evaluate, '_Environment': lab.Environment,
+                          '_params': tuple(func.params), '_env': func.env,
+                          '_SnekEvaluationError': lab.SnekEvaluationError}
+        self.guards = {} #free name -> the builtin it resolved to
+
+    def constant(self, value):
+        name = '_k%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def builtin(self, name):
+        '''
+        Returns the builtin that name refers to in the function's
+        environment, or None if it is not a builtin
+        '''
+        if name in self.locals:
+            return None
+        owner = self.func.env.find(name)
+        if owner is not lab.builtin_env:
+            return None
+        self.guards[name] = owner.att[name]
+        return owner.att[name]
+
+    def operand(self, tree):
+        '''
+        Translates tree as an operand of a Python operator, checking (as the
+        builtins do) that it is a number unless it is sure to be one
+        '''
+        code = self.expr(tree)
+        if isinstance(tree, (int, float)):
+            return code
+        if (isinstance(tree, list) and tree and isinstance(tree[0], str)
+                and tree[0] in binary_ops and self.builtin(tree[0]) is not None):
+            return code #the result of an arithmetic or comparison builtin
+        return '_num(%s)' % code
+
+    def expr(self, tree):
+        if isinstance(tree, (int, float)):
+            if isinstance(tree, float) and not math.isfinite(tree):
+                return self.constant(tree)
+            return repr(tree)
+        if isinstance(tree, str):
+            if tree in self.locals:
+                return self.locals[tree]
+            return '_lookup(%r)' % tree
+        if not tree:
+            return '_fail()'
+        if tree[0] == 'lambda' or tree[0] in lab.define_forms:
+            #left to the interpreter, in a frame like the one a call creates
+            args = ''.join(self.locals[p] + ', ' for p in self.func.params)
+            return '_evaluate(%s, _Environment(zip(_params, (%s)), _env))' % (self.constant(tree), args)
+        head = tree[0]
+        if isinstance(head, str) and self.builtin(head) is not None:
+            if head not in binary_ops:
+                args = [self.expr(t) for t in tree[1:]]
+                return '%s([%s])' % (self.constant(self.guards[head]), ', '.join(args))
+            args = [self.operand(t) for t in tree[1:]]
+            op = binary_ops.get(head)
+            if op is not None and len(args) == 2:
+                return '(%s %s %s)' % (args[0], op, args[1])
+            if head == '+' and args:
+                return '(0 + %s)' % ' + '.join(args) #0 + as in sum, for (+ -0.0)
+            if head == '-' and len(args) == 1:
+                return '(-%s)' % args[0]
+            if head == '-' and args:
+                return '(%s - (%s))' % (args[0], ' + '.join(args[1:]))
+            if head in ('*', '/') and args:
+                product = args[-1]
+                for a in reversed(args[1:-1] if head == '/' else args[:-1]):
+                    product = '(%s * %s)' % (a, product)
+                if head == '/' and len(args) > 1:
+                    return '(%s / %s)' % (args[0], product)
+                return product if head == '*' else args[0]
+            return '%s([%s])' % (self.constant(self.guards[head]), ', '.join(args))
+        args = [self.expr(t) for t in tree[1:]]
+        return '_call(%s, [%s])' % (self.expr(head), ', '.join(args))
+
+    def source(self):
+        params = ', '.join('a%d' % i for i in range(len(self.func.params)))
+        return ('def snek(%s):\n'
+                '    try:\n'
+                '        return %s\n'
+                '    except (TypeError, ZeroDivisionError):\n'
+                '        raise _SnekEvaluationError from None\n') % (params, self.expr(self.func.body))
+
+
+def translate(func):
+    """
+    Returns the Python source that func's body translates to, or None if it
+    cannot be translated.
+
+    >>> env = lab.Environment({})
+    >>> f = lab.evaluate(lab.parse(lab.tokenize('(define (f x y) (* 2 (+ x y) (g x)))')), env)
+    >>> print(translate(f))
+    def snek(a0, a1):
+        try:
+            return (2 * ((_num(a0) + _num(a1)) * _num(_call(_lookup('g'), [a0]))))
+        except (TypeError, ZeroDivisionError):
+            raise _SnekEvaluationError from None
+    <BLANKLINE>
+    """
+    result = _translate(func)
+    return result and result[0]
+
+
+def _translate(func):
+    '''
+    Returns (source, Python function, guards) for func, or None
+    '''
+    if not isinstance(func, lab.Function) or _defines_locally(func.body):
+        return None
+    if not isinstance(func.env, lab.Environment): #e.g. a compiled closure's Frame
+        return None
+    translator = _Translator(func)
+    try:
+        source = translator.source()
+        exec(compile(source, '<snek %s>' % (func.name or 'lambda'), 'exec'), translator.namespace)
+    except (RecursionError, MemoryError, SyntaxError): #e.g. very deeply nested
+        return None
+    return source, translator.namespace['snek'], translator.guards
+
+
+class NativeFunction(lab.Function):
+    """
+    A Function whose body has been translated to the Python function native.
+    guards maps the free names translated as builtins to those builtins;
+    version is the Environment.version at which they were last checked.
+    """
+    def __init__(self, func, native, guards):
+        lab.Function.__init__(self, func.params, func.body, func.env)
+        self.name = func.name
+        self.memo = func.memo
+        self.native = native
+        self.guards = guards
+        self.version = lab.Environment.version
+
+    def run(self, args):
+        if lab.Environment.version != self.version and not self.check():
+            return lab.Function.run(self, args)
+        return self.native(*args)
+
+    def check(self):
+        '''
+        Returns whether every guarded name still refers to its builtin
+        '''
+        version = lab.Environment.version
+        for name, builtin in self.guards.items():
+            owner = self.env.find(name)
+            if owner is not lab.builtin_env or owner.att[name] is not builtin:
+                return False
+        self.version = version
+        return True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['native'] #a Python function; translated again after loading
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        def native(*args):
+            #translated on the first call, as env may still be half-loaded
+            self.native = _translate(self)[1]
+            return self.native(*args)
+        self.native = native
+
+
+def native(func):
+    """
+    Returns a NativeFunction equivalent to func, or func itself if it cannot
+    be translated.
+    """
+    if type(func) is NativeFunction:
+        return func
+    result = _translate(func)
+    if result is None:
+        return func
+    _, python, guards = result
+    return NativeFunction(func, python, guards)
+
+
+def install(env, names=None):
+    """
+    Replaces the Functions bound in env (or just those with the given names)
+    by NativeFunctions, and returns the names that were replaced.
+    """
+    if names is None:
+        names = list(env.att)
+    installed = []
+    for name in names:
+        func = env.att.get(name)
+        if isinstance(func, lab.Function) and type(func) is not NativeFunction:
+            translated = native(func)
+            if translated is not func:
+                env.define(name, translated)
+                installed.append(name)
+    return installed
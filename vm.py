@@ -0,0 +1,453 @@
+"""
+A stack-based bytecode virtual machine for Snek.
+
+This is an alternative backend to lab.evaluate: compile turns the output of
+lab.parse into a CodeObject, and execute runs it in a lab.Environment with a
+single dispatch loop.  Snek calls push a new frame onto an explicit call
+stack instead of recursing in Python, so neither deep nor long chains of
+calls grow the Python stack.  This includes calls to memoized functions and
+to functions made by lab.evaluate or compiled code, whose bodies are
+compiled for the VM when they are first called from it.  The same loop can
+also stop after a number of steps and resume later: Task and schedule use
+this to interleave many programs on one thread and to cap runaway ones.
+"""
+import time
+import collections
+from array import array
+
+import lab
+
+#opcodes; every instruction is an (opcode, argument) pair of ints
+LOAD_CONST = 0    #push consts[arg]
+LOAD_NAME = 1     #push the value of names[arg]
+DEFINE = 2        #bind names[arg] to the top of the stack (leaving it there)
+MAKE_CLOSURE = 3  #push a function for the CodeObject consts[arg]
+CALL = 4          #call the function under the top arg values
+TAIL_CALL = 5     #like CALL, but replace the current frame
+RETURN = 6        #return the top of the stack to the caller
+FAIL = 7          #raise a SnekEvaluationError
+MEMOIZE = 8       #mark the function on top of the stack as memoized
+
+opnames = ['LOAD_CONST', 'LOAD_NAME', 'DEFINE', 'MAKE_CLOSURE', 'CALL',
+           'TAIL_CALL', 'RETURN', 'FAIL', 'MEMOIZE']
+
+
+class CodeObject:
+    """
+    Compiled bytecode for one Snek expression or function body.
+
+    Attributes:
+        code (array): flat array of opcode, argument pairs
+        consts (list): numbers and nested CodeObjects referenced by code
+        names (list): variable names referenced by code
+        params (list): parameter names, if this is a function body
+        body: the parsed function body this was compiled from, if any
+    """
+    __slots__ = ('code', 'consts', 'names', 'params', 'body', 'index')
+
+    def __init__(self, params=(), body=None):
+        self.code = array('l')
+        self.consts = []
+        self.names = []
+        self.params = list(params)
+        self.body = body
+        self.index = {} #(table, type, value) -> position, for deduplication
+
+    def emit(self, op, arg=0):
+        self.code.append(op)
+        self.code.append(arg)
+
+    def add(self, table, value):
+        '''
+        Returns the index of value in table (consts or names), adding it
+        if it is not there yet.  CodeObjects are never shared.
+        '''
+        if isinstance(value, CodeObject):
+            table.append(value)
+            return len(table) - 1
+        key = (table is self.names, type(value), value)
+        if key not in self.index:
+            self.index[key] = len(table)
+            table.append(value)
+        return self.index[key]
+
+
+class VMFunction(lab.Function):
+    """
+    A Function created by the VM: alongside its params and body it keeps
+    code, the CodeObject its body was compiled to.
+    """
+    def __init__(self, param, body, env, code):
+        lab.Function.__init__(self, param, body, env)
+        self.code = code
+
+    def run(self, args):
+        return execute(self.code, lab.Environment(zip(self.params, args), self.env))
+
+
+_emit = object() #marks a pending instruction on the compiler's work stack
+
+def _compile_into(out, tree, tail):
+    '''
+    Appends to the CodeObject out the instructions that push the value of
+    tree; tail says whether tree is in tail position.  Uses an explicit work
+    stack of (code object, tree, tail) entries, so nesting depth is unlimited.
+    '''
+    todo = [(out, tree, tail)]
+    while todo:
+        out, tree, tail = todo.pop()
+        if tree is _emit: #tail holds the (opcode, argument) to append
+            out.emit(*tail)
+        elif isinstance(tree, (int, float)):
+            out.emit(LOAD_CONST, out.add(out.consts, tree))
+        elif isinstance(tree, str):
+            out.emit(LOAD_NAME, out.add(out.names, tree))
+        elif not tree:
+            out.emit(FAIL)
+        elif tree[0] in lab.define_forms:
+            if isinstance(tree[1], list): #function definition shorthand
+                todo.append((out, _emit, (DEFINE, out.add(out.names, tree[1][0]))))
+            else:
+                todo.append((out, _emit, (DEFINE, out.add(out.names, tree[1]))))
+            if tree[0] == 'define-memo':
+                todo.append((out, _emit, (MEMOIZE, 0)))
+            if isinstance(tree[1], list):
+                todo.extend(_compile_lambda(out, tree[1][1:], tree[2]))
+            else:
+                todo.append((out, tree[2], False))
+        elif tree[0] == 'lambda':
+            todo.extend(_compile_lambda(out, tree[1], tree[2]))
+        else:
+            todo.append((out, _emit, (TAIL_CALL if tail else CALL, len(tree) - 1)))
+            for t in reversed(tree):
+                todo.append((out, t, False))
+
+
+def _compile_lambda(out, params, body):
+    '''
+    Returns the work stack entries that compile a lambda into its own
+    CodeObject and make a closure for it in out
+    '''
+    code = CodeObject(params, body)
+    return [(out, _emit, (MAKE_CLOSURE, out.add(out.consts, code))),
+            (code, _emit, (RETURN, 0)),
+            (code, body, True)]
+
+
+def compile(tree):
+    """
+    Compiles a parsed expression (the output of lab.parse) into a CodeObject.
+    """
+    out = CodeObject()
+    _compile_into(out, tree, False)
+    out.emit(RETURN)
+    return out
+
+
+def execute(code, env):
+    """
+    Runs a CodeObject in the given environment and returns its value.
+    """
+    return _run((code.code, code.consts, code.names, 0, env, [], []), -1)[1]
+
+
+_function_codes = {} #id(body) -> (body, params, CodeObject)
+
+def _function_code(func):
+    '''
+    Returns a CodeObject for the body of a Function that was not made by the
+    VM (e.g. by lab.evaluate), compiling it on first use
+    '''
+    entry = _function_codes.get(id(func.body))
+    if entry is not None and entry[0] is func.body and entry[1] == func.params:
+        return entry[2]
+    code = CodeObject(func.params, func.body)
+    _compile_into(code, func.body, True)
+    code.emit(RETURN)
+    if len(_function_codes) >= 4096: #bounded, as sessions keep making code
+        _function_codes.clear()
+    _function_codes[id(func.body)] = (func.body, list(func.params), code)
+    return code
+
+
+class _FrameBindings:
+    '''
+    A read-only view of the bound slots of a lab.Frame, usable as the att
+    dict of an Environment
+    '''
+    __slots__ = ('frame',)
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __contains__(self, key):
+        i = self.frame.scope.index.get(key)
+        return i is not None and self.frame.values[i] is not lab._unbound
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.frame.values[self.frame.scope.index[key]]
+
+
+class _FrameEnv:
+    '''
+    Stands in for the lab.Frame chain a compiled closure was made in, so that
+    the Environments the VM makes for calling it can have it as a parent
+    '''
+    __slots__ = ('att', 'parent')
+
+    def __init__(self, frame):
+        self.att = _FrameBindings(frame)
+        parent = frame.parent
+        self.parent = _FrameEnv(parent) if type(parent) is lab.Frame else parent
+
+
+def _run(state, budget):
+    '''
+    The dispatch loop.  state is the (ops, consts, names, pc, env, stack,
+    calls) of a computation, where calls holds, for each caller, the same
+    tuple with store in place of calls: None, or the (MemoCache, key) that
+    the result of its pending call is to be remembered under.  Runs until
+    the computation returns, giving (True, value, budget left), or until it
+    is about to make a call with no budget left, giving (False, state to
+    resume from, 0).  Each call costs one step; a negative budget never runs
+    out.  Every Snek function, whoever made it and whether or not it is
+    memoized, runs in this loop; only builtins are called directly.
+    '''
+    ops, consts, names, pc, env, stack, calls = state
+    while True:
+        op = ops[pc]
+        arg = ops[pc + 1]
+        pc += 2
+        if op == LOAD_NAME:
+            stack.append(env.lookup(names[arg]))
+        elif op == LOAD_CONST:
+            stack.append(consts[arg])
+        elif op == CALL or op == TAIL_CALL:
+            if not budget: #suspend just before this call
+                return (False, (ops, consts, names, pc - 2, env, stack, calls), 0)
+            budget -= 1
+            if arg:
+                args = stack[-arg:]
+                del stack[-arg:]
+            else:
+                args = []
+            func = stack.pop()
+            if type(func) is VMFunction and func.memo is None:
+                if len(args) != len(func.params):
+                    raise lab.SnekEvaluationError
+                if op == CALL:
+                    calls.append((ops, consts, names, pc, env, stack, None))
+                code = func.code
+                ops, consts, names = code.code, code.consts, code.names
+                pc = 0
+                env = lab.Environment(zip(func.params, args), func.env)
+                stack = []
+            elif isinstance(func, lab.Function):
+                if len(args) != len(func.params):
+                    raise lab.SnekEvaluationError
+                store = None
+                if func.memo is not None:
+                    key = func.memo.key(args)
+                    found, val = func.memo.get(key)
+                    if found:
+                        stack.append(val)
+                        continue
+                    store = (func.memo, key)
+                if op == CALL or store is not None: #a TAIL_CALL is followed by RETURN
+                    calls.append((ops, consts, names, pc, env, stack, store))
+                code = func.code if type(func) is VMFunction else _function_code(func)
+                ops, consts, names = code.code, code.consts, code.names
+                pc = 0
+                parent = _FrameEnv(func.env) if type(func.env) is lab.Frame else func.env
+                env = lab.Environment(zip(func.params, args), parent)
+                stack = []
+            elif callable(func):
+                stack.append(func(args))
+            else:
+                raise lab.SnekEvaluationError
+        elif op == RETURN:
+            if not calls:
+                return (True, stack[-1], budget)
+            val = stack[-1]
+            ops, consts, names, pc, env, stack, store = calls.pop()
+            if store is not None:
+                store[0].put(store[1], val)
+            stack.append(val)
+        elif op == MAKE_CLOSURE:
+            body = consts[arg]
+            stack.append(VMFunction(body.params, body.body, env, body))
+        elif op == DEFINE:
+            env.define(names[arg], stack[-1])
+        elif op == MEMOIZE:
+            lab.memoize(stack[-1])
+        else:
+            raise lab.SnekEvaluationError
+
+
+class Task:
+    """
+    A Snek computation on the VM that runs a limited number of steps at a
+    time, so that a scheduler can interleave many of them on one thread (see
+    schedule).  A step is one function call; as Snek has no loops, every
+    non-terminating program keeps making calls.  Functions made by the
+    other engines and memoized functions run step by step on the VM too (a
+    memoized call that finds its result costs one step).  A builtin call is
+    a single step however long it takes, so pmap, which calls a function
+    for each of its values, is not interrupted.
+
+    Arguments:
+        tree: a parsed expression, or a CodeObject from compile
+        env: the global Environment; a fresh one by default
+        max_steps (int): total steps after which run raises SnekLimitError
+        max_seconds (float): total running time after which run raises
+                             SnekLimitError
+
+    Once done is True, either result holds the value of the expression or
+    error holds the exception it raised.
+    """
+    check_every = 1000 #steps between checks of the clock
+
+    def __init__(self, tree, env=None, max_steps=None, max_seconds=None):
+        code = tree if isinstance(tree, CodeObject) else compile(tree)
+        if env is None:
+            env = lab.Environment({})
+        self.state = (code.code, code.consts, code.names, 0, env, [], [])
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.steps = 0
+        self.seconds = 0.0
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def _fail(self, error):
+        self.done = True
+        self.state = None
+        self.error = error
+        raise error
+
+    def run(self, steps=None, seconds=None):
+        '''
+        Runs the computation until it finishes or has used the given number
+        of steps or seconds (either may be None for no limit), and returns
+        whether it has finished.  Errors raised by the program, and
+        SnekLimitError when a hard limit is reached, end the task and are
+        re-raised.
+        '''
+        if self.done:
+            return True
+        start = time.perf_counter()
+        deadline = start + seconds if seconds is not None else None
+        if self.max_seconds is not None:
+            hard = start + self.max_seconds - self.seconds
+            deadline = hard if deadline is None else min(deadline, hard)
+        try:
+            while True:
+                budget = self.check_every if deadline is not None else -1
+                if steps is not None:
+                    budget = steps if budget < 0 else min(budget, steps)
+                if self.max_steps is not None:
+                    left = self.max_steps - self.steps
+                    budget = left if budget < 0 else min(budget, left)
+                done, value, left = _run(self.state, budget)
+                used = budget - left
+                self.steps += used
+                if steps is not None:
+                    steps -= used
+                if done:
+                    self.done = True
+                    self.result = value
+                    self.state = None
+                    return True
+                self.state = value
+                if self.max_steps is not None and self.steps >= self.max_steps:
+                    self._fail(lab.SnekLimitError('more than %d steps' % self.max_steps))
+                now = time.perf_counter()
+                if self.max_seconds is not None and self.seconds + now - start >= self.max_seconds:
+                    self._fail(lab.SnekLimitError('more than %g seconds' % self.max_seconds))
+                if steps == 0 or (deadline is not None and now >= deadline):
+                    return False
+        except lab.SnekLimitError:
+            raise
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def schedule(tasks, steps=1000):
+    """
+    Runs tasks round-robin on this thread, giving each up to steps steps in
+    turn, and yields each task as soon as it is done (finished, failed or
+    stopped by one of its limits); check its result and error attributes.
+    """
+    queue = collections.deque(tasks)
+    while queue:
+        task = queue.popleft()
+        try:
+            done = task.run(steps)
+        except Exception:
+            done = True
+        if done:
+            yield task
+        else:
+            queue.append(task)
+
+
+def evaluate(tree, env=None):
+    """
+    Evaluates a parsed expression on the VM.  Takes the same arguments as
+    lab.evaluate.
+    """
+    if env is None:
+        env = lab.Environment({})
+    return execute(compile(tree), env)
+
+
+def result_and_env(tree, env=None):
+    '''
+    Like lab.result_and_env, but running on the VM
+    '''
+    if env is None:
+        env = lab.Environment({})
+    return (evaluate(tree, env), env)
+
+
+def dis(code, indent=''):
+    """
+    Returns a human-readable listing of a CodeObject and, indented below it,
+    of the function bodies it contains.
+
+    >>> print(dis(compile(lab.parse(lab.tokenize('(define (inc x) (+ x 1))')))))
+        0 MAKE_CLOSURE   0 (lambda (x))
+        2 DEFINE         0 (inc)
+        4 RETURN
+      code for (lambda (x)):
+            0 LOAD_NAME      0 (+)
+            2 LOAD_NAME      1 (x)
+            4 LOAD_CONST     0 (1)
+            6 TAIL_CALL      2
+            8 RETURN
+    """
+    lines = []
+    nested = []
+    for pc in range(0, len(code.code), 2):
+        op, arg = code.code[pc], code.code[pc + 1]
+        line = '%s%5d %-15s' % (indent, pc, opnames[op])
+        if op == LOAD_CONST:
+            line += '%d (%r)' % (arg, code.consts[arg])
+        elif op in (LOAD_NAME, DEFINE):
+            line += '%d (%s)' % (arg, code.names[arg])
+        elif op == MAKE_CLOSURE:
+            body = code.consts[arg]
+            line += '%d (lambda (%s))' % (arg, ' '.join(body.params))
+            nested.append(body)
+        elif op in (CALL, TAIL_CALL):
+            line += '%d' % arg
+        lines.append(line.rstrip())
+    for body in nested:
+        lines.append('%s  code for (lambda (%s)):' % (indent, ' '.join(body.params)))
+        lines.append(dis(body, indent + '    '))
+    return '\n'.join(lines)